@@ -0,0 +1,137 @@
+import json
+import numpy as np
+import pandas as pd
+
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os import replace
+from os.path import exists
+from typing import Dict, List, Tuple
+
+
+class LatencySketch():
+    """
+    A streaming quantile sketch in the spirit of DDSketch (Masson et al., VLDB '19):
+    latencies are counted in logarithmic buckets, so every quantile is answered within relative_accuracy
+    of the true value with memory logarithmic in the range of the latencies, and sketches can be merged.
+    Failed resolutions (NaN latencies) are counted apart.
+    """
+    def __init__(self, relative_accuracy : float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.buckets : Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.failures = 0
+
+    def add(self, latencies):
+        latencies = np.asarray(latencies, dtype=np.float64)
+        failed = np.isnan(latencies)
+        self.failures += int(failed.sum())
+        latencies = latencies[~failed]
+
+        positive = latencies > 0
+        self.zero_count += int((~positive).sum())
+        self.count += len(latencies)
+
+        indices, counts = np.unique(np.ceil(np.log(latencies[positive]) / self.log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other : 'LatencySketch'):
+        if (other.relative_accuracy != self.relative_accuracy):
+            raise Exception('Cannot merge sketches of different relative accuracies')
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.failures += other.failures
+
+    def quantile(self, q : float) -> float:
+        if (self.count == 0):
+            return np.nan
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if (rank < seen):
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if (rank < seen):
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self) -> dict:
+        return {'relative_accuracy' : self.relative_accuracy, 'buckets' : {str(index) : count for index, count in self.buckets.items()},
+                'zero_count' : self.zero_count, 'count' : self.count, 'failures' : self.failures}
+
+    @staticmethod
+    def from_dict(data : dict) -> 'LatencySketch':
+        sketch = LatencySketch(data['relative_accuracy'])
+        sketch.buckets = {int(index) : count for index, count in data['buckets'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.failures = data['failures']
+        return sketch
+
+
+class LatencySummaries():
+    """
+    The latency sketches of every rank range and of every domain, per origin and name server, kept in a single JSON file.
+    Several processes (e.g. one per origin) can share the file: each one only keeps the sketches of its own new measurements,
+    and merges them into the file under a lock, rewriting it atomically so readers always see a complete summary.
+    """
+    def __init__(self, path : str, relative_accuracy : float = 0.01):
+        self.path = path
+        self.relative_accuracy = relative_accuracy
+        self.sketches = self._load()
+        self.pending : Dict[str, Dict[str, LatencySketch]] = {'ranges' : {}, 'domains' : {}}
+
+    def _load(self) -> Dict[str, Dict[str, LatencySketch]]:
+        if (not exists(self.path)):
+            return {'ranges' : {}, 'domains' : {}}
+        with open(self.path) as f:
+            stored = json.load(f)
+        return {kind : {key : LatencySketch.from_dict(data) for key, data in sketches.items()} for kind, sketches in stored.items()}
+
+    def _sketch(self, kind : str, key : str) -> LatencySketch:
+        if (key not in self.pending[kind]):
+            self.pending[kind][key] = LatencySketch(self.relative_accuracy)
+        return self.pending[kind][key]
+
+    def update(self, measurements_df : pd.DataFrame, origin : str, dns_server : str, ranks : Tuple[int, int]):
+        self._sketch('ranges', f'{origin}/{dns_server}/{ranks[0]}_{ranks[1]}').add(measurements_df['latency'])
+        for domain, latency in zip(measurements_df['domain'].tolist(), measurements_df['latency'].tolist()):
+            self._sketch('domains', f'{origin}/{dns_server}/{domain}').add([latency])
+
+    def save(self):
+        """
+        Merges the measurements added since the last save into the summaries file, reloading it first
+        so the sketches saved meanwhile by other processes are kept.
+        """
+        with open(f'{self.path}.lock', 'w') as lock:
+            flock(lock, LOCK_EX)
+            try:
+                self.sketches = self._load()
+                for kind, sketches in self.pending.items():
+                    for key, sketch in sketches.items():
+                        if (key in self.sketches[kind]):
+                            self.sketches[kind][key].merge(sketch)
+                        else:
+                            self.sketches[kind][key] = sketch
+
+                with open(f'{self.path}.tmp', 'w') as f:
+                    json.dump({kind : {key : sketch.to_dict() for key, sketch in sketches.items()} for kind, sketches in self.sketches.items()}, f)
+                replace(f'{self.path}.tmp', self.path)
+            finally:
+                flock(lock, LOCK_UN)
+
+        self.pending = {'ranges' : {}, 'domains' : {}}
+
+    def quantiles(self, kind : str = 'ranges', qs : List[float] = [0.5, 0.9, 0.99]) -> pd.DataFrame:
+        """
+        The quantiles of every sketch of the given kind ('ranges' or 'domains') as a DataFrame indexed by its key,
+        as of the last load or save of the summaries file.
+        """
+        return pd.DataFrame.from_dict({key : {'count' : sketch.count, 'failures' : sketch.failures, **{f'p{q * 100:g}' : sketch.quantile(q) for q in qs}}
+                                       for key, sketch in self.sketches[kind].items()}, orient='index')
@@ -1,6 +1,9 @@
 import argparse
+import asyncio
 import dns
-import dns.resolver
+import dns.asyncresolver
+import dns.message
+import dns.rrset
 from dns.exception import Timeout as TimeoutException
 import pandas as pd
 import numpy as np
@@ -13,36 +16,90 @@ from os.path import exists
 from pathlib import Path
 from zipfile import ZipFile
 from tqdm import tqdm
-from typing import Tuple, List, Literal
+from multiprocessing import Event, Process
+from threading import Lock
+from typing import Dict, Tuple, List, Literal
 
-from datetime import timedelta, datetime
-from time import sleep
+from time import perf_counter_ns
+
+from latency_sketch import LatencySummaries
 
 
 BASE_DIR = f'{Path(__file__).parent.resolve()}'
 ALEXA_RANKING_PATH = f'{BASE_DIR}/alexa_top_1m.csv'
 UMBRELLA_RANKING_PATH = f'{BASE_DIR}/umbrella_top_1m.csv'
 ALEXA_DOWNLOAD_URL = 'http://s3.amazonaws.com/alexa-static/top-1m.csv.zip'
+MEASUREMENTS_DIR = f'{BASE_DIR}/measurements'
+SUMMARIES_PATH = f'{BASE_DIR}/latency_summaries.json'
 UMBRELLA_DOWNLOAD_URL = 'http://s3-us-west-1.amazonaws.com/umbrella-static/top-1m.csv.zip'
 
-# * Setting the Timeout and Lifetime of each query to 2 seconds, removing some of the outliers.
-dns_resolver = dns.resolver.Resolver()
-dns_resolver.lifetime = 3
-dns_resolver.timeout = 3
-dns_resolver.nameservers = []
-
-
-def set_dns_nameserver(option : Literal['google_main', 'google_secondary', 'opendns_main', 'opendns_secondary']):
-    if (option == 'google_main'):
-        dns_resolver.nameservers = ['8.8.8.8']
-    elif (option == 'google_secondary'):
-        dns_resolver.nameservers = ['8.8.4.4']
-    elif (option == 'opendns_main'):
-        dns_resolver.nameservers = ['208.67.222.222']
-    elif (option == 'opendns_secondary'):
-        dns_resolver.nameservers = ['208.67.220.220']
-    else:
+# * Serializes the writes of the measurements and summaries of overlapping iterations, which run in worker threads
+STORE_LOCK = Lock()
+
+# * Setting the Timeout and Lifetime of each query to 3 seconds, removing some of the outliers.
+DNS_TIMEOUT = 3
+
+NAMESERVERS = {
+    'google_main' : '8.8.8.8',
+    'google_secondary' : '8.8.4.4',
+    'opendns_main' : '208.67.222.222',
+    'opendns_secondary' : '208.67.220.220',
+    # * A stub server started by this script, answering every query locally (see StubDNSServer)
+    'local_stub' : '127.0.0.1',
+}
+
+
+def create_dns_resolver(option : Literal['google_main', 'google_secondary', 'opendns_main', 'opendns_secondary', 'local_stub'],
+                        stub_port : int = 5353) -> dns.asyncresolver.Resolver:
+    if (option not in NAMESERVERS):
         raise Exception(f'No option {option} for DNS name server')
+    
+    dns_resolver = dns.asyncresolver.Resolver(configure=False)
+    dns_resolver.lifetime = DNS_TIMEOUT
+    dns_resolver.timeout = DNS_TIMEOUT
+    dns_resolver.nameservers = [NAMESERVERS[option]]
+    if (option == 'local_stub'):
+        dns_resolver.port = stub_port
+    return dns_resolver
+
+
+class StubDNSServer(asyncio.DatagramProtocol):
+    """
+    A minimal UDP DNS server for offline testing, answering every A query with 127.0.0.1 after a fixed delay.
+    """
+    def __init__(self, delay_ms : float = 0):
+        self.delay = delay_ms / 1000
+        self.transport = None
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    
+    def datagram_received(self, data : bytes, addr):
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        for question in query.question:
+            response.answer.append(dns.rrset.from_text(question.name, 60, 'IN', 'A', '127.0.0.1'))
+        asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, response.to_wire(), addr)
+
+
+def serve_stub_dns_server(port : int, delay_ms : float, ready):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(loop.create_datagram_endpoint(lambda: StubDNSServer(delay_ms), local_addr=('127.0.0.1', port)))
+    ready.set()
+    loop.run_forever()
+
+
+def start_stub_dns_server(port : int, delay_ms : float = 0) -> Process:
+    """
+    Serves the stub from its own process, so its answers neither wait behind the timing loop's work nor compete with it for the GIL.
+    """
+    ready = Event()
+    stub_process = Process(target=serve_stub_dns_server, args=(port, delay_ms, ready), name='stub-dns-server', daemon=True)
+    stub_process.start()
+    while (not ready.wait(1)):
+        if (not stub_process.is_alive()):
+            raise Exception(f'The stub DNS server failed to start on port {port}')
+    return stub_process
 
 
 def download_alexa_top_entries_if_needed():
@@ -64,25 +121,41 @@ def download_and_extract(url : str, dest_path : str):
             rename(f'{BASE_DIR}/top-1m.csv', dest_path)
                     
 
-def time_name_resolution(domain_entry : pd.Series):
-    domain = domain_entry['domain']
-    
-    send_time = datetime.now()
-    try:
-        if 'resolve' in dir(dns.resolver):
-            result = dns_resolver.resolve(domain, 'A', search=True)
-        else:
-            result = dns_resolver.query(domain, 'A')
+async def time_name_resolution(dns_resolver : dns.asyncresolver.Resolver, domain : str, semaphore : asyncio.Semaphore) -> float:
+    async with semaphore:
+        send_time = perf_counter_ns()
+        try:
+            await dns_resolver.resolve(domain, 'A', search=True)
+        except TimeoutException as e:
+            return dns_resolver.timeout * 1000
+        except Exception as e:
+            return np.nan
         
-    except TimeoutException as e:
-        return dns_resolver.timeout * 1000
-    except Exception as e:
-        return np.nan
+        receive_time = perf_counter_ns()
+    
+    return (receive_time - send_time) / 1e6
+
+
+async def time_domains(domains : List[str], dns_resolvers : Dict[str, dns.asyncresolver.Resolver], concurrency : int,
+                       verbose : bool = False) -> Dict[str, List[float]]:
+    """
+    Times the resolution of every domain on every name server in a single pass, with at most concurrency queries in flight.
+    Returns the latencies in milliseconds of each name server, in the order of the domains.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = tqdm(total=len(domains) * len(dns_resolvers)) if verbose else None
     
-    receive_time = datetime.now()
+    async def timed(dns_resolver, domain):
+        latency = await time_name_resolution(dns_resolver, domain, semaphore)
+        if (progress is not None):
+            progress.update()
+        return latency
     
-    stat_duration = receive_time - send_time
-    return stat_duration.total_seconds() * 1000
+    latencies = await asyncio.gather(*[timed(dns_resolver, domain) for dns_resolver in dns_resolvers.values() for domain in domains])
+    if (progress is not None):
+        progress.close()
+    
+    return {dns_server : latencies[i * len(domains):(i + 1) * len(domains)] for i, dns_server in enumerate(dns_resolvers)}
 
 
 def parse_arguments():
@@ -93,8 +166,14 @@ def parse_arguments():
     # parser.add_argument('--high', help='The highest rank to stat', type=int, required=True)
     # parser.add_argument('--low', help='The lowest rank to stat', type=int, required=True)
     parser.add_argument('-v', '--verbose', help='Prints progress bar for computation', action='store_true')
-    parser.add_argument('--dns-server', help='Choose the DNS name server to query', choices=['google_main', 'google_secondary', 'opendns_main', 'opendns_secondary'], required=True)
+    parser.add_argument('--dns-server', help='Choose the DNS name servers to query, all of them are timed in the same pass', nargs='+', choices=list(NAMESERVERS), required=True)
     parser.add_argument('-b', '--batch-size', help='The batch size to sample on each iteration', default=200, type=int)
+    parser.add_argument('-c', '--concurrency', help='The maximal number of queries in flight. The queries in flight share the event loop and CPU of this process, so high values inflate the measured latencies', default=10, type=int)
+    parser.add_argument('-i', '--interval', help='Seconds between the starts of consecutive iterations', default=60, type=float)
+    parser.add_argument('-n', '--iterations', help='Stop after this many iterations, runs forever if not given', type=int)
+    parser.add_argument('-s', '--store', help='Store the measurements as parquet files partitioned by origin, name server and rank range, or append them to a csv per rank range', choices=['parquet', 'csv'], default='parquet')
+    parser.add_argument('--stub-port', help='The UDP port of the local_stub name server', default=5353, type=int)
+    parser.add_argument('--stub-delay', help='The delay in milliseconds of every local_stub answer', default=0, type=float)
     
     return parser.parse_args()
 
@@ -107,50 +186,124 @@ def prepare_ranking_dfs(origin : Literal['alexa', 'umbrella'], ranks : List[Tupl
     return [ranking_df.loc[(ranking_df['rank'] >= high) & (ranking_df['rank'] <= low)] for high, low in ranks]
 
 
-def run_timing_iteration(curr_sampled_df : pd.DataFrame, curr_ranks : Tuple[int, int], iteration : int, 
-                         origin : str, dns_server : str, verbose : bool = False):
-    if (verbose):
-            tqdm.pandas()
-            curr_sampled_df['latency'] = curr_sampled_df.progress_apply(time_name_resolution, axis=1)
-    else:
-        curr_sampled_df['latency'] = curr_sampled_df.apply(time_name_resolution, axis=1)
-    
-    curr_sampled_df = curr_sampled_df.assign(iteration=f'{iteration}')  
-    
+def store_measurements_csv(measurements_df : pd.DataFrame, curr_ranks : Tuple[int, int], origin : str, dns_server : str):
     output_csv_path = f'{BASE_DIR}/time_rank_{origin}_{dns_server}_{curr_ranks[0]}_{curr_ranks[1]}.csv'
-
+    
     should_append_header = not exists(output_csv_path)
-    curr_sampled_df.to_csv(output_csv_path, mode='a', header=should_append_header, index=False)
+    measurements_df.to_csv(output_csv_path, mode='a', header=should_append_header, index=False)
 
 
-def main():
-    args = parse_arguments()
-    
-    if (args.download):
-        if (args.origin == 'alexa'):
-            download_alexa_top_entries_if_needed()
-        else:
-            download_umbrella_top_entries_if_needed()
+def store_measurements_parquet(measurements_df : pd.DataFrame, curr_ranks : Tuple[int, int], origin : str, dns_server : str):
+    """
+    Writes the measurements of an iteration as a new file under MEASUREMENTS_DIR/origin=.../dns_server=.../ranks=...,
+    so the store is only ever appended to and can be read back as a single dataset with pd.read_parquet(MEASUREMENTS_DIR).
+    """
+    measurements_df = measurements_df.astype({'rank' : 'int64', 'latency' : 'float64', 'iteration' : 'int64'})
+    measurements_df = measurements_df.assign(origin=origin, dns_server=dns_server, ranks=f'{curr_ranks[0]}_{curr_ranks[1]}')
+    measurements_df.to_parquet(MEASUREMENTS_DIR, partition_cols=['origin', 'dns_server', 'ranks'], index=False)
+
+
+def store_iteration(curr_sampled_df : pd.DataFrame, curr_ranks : Tuple[int, int], iteration : int, origin : str,
+                    latencies : Dict[str, List[float]], summaries : LatencySummaries, store : Literal['parquet', 'csv'] = 'parquet'):
+    """
+    Stores the measurements of an iteration and saves them to the summaries. It runs in a worker thread, under STORE_LOCK,
+    so the writes of overlapping iterations neither stall the event loop timing the queries nor interleave.
+    """
+    with STORE_LOCK:
+        for dns_server, server_latencies in latencies.items():
+            if (store == 'csv'):
+                store_measurements_csv(curr_sampled_df.assign(latency=server_latencies, iteration=f'{iteration}'), curr_ranks, origin, dns_server)
+            else:
+                store_measurements_parquet(curr_sampled_df.assign(latency=server_latencies, iteration=iteration), curr_ranks, origin, dns_server)
             
-    set_dns_nameserver(args.dns_server)
+            summaries.update(curr_sampled_df.assign(latency=server_latencies), origin, dns_server, curr_ranks)
+        
+        summaries.save()
+
+
+async def run_timing_iteration(curr_sampled_df : pd.DataFrame, curr_ranks : Tuple[int, int], iteration : int, 
+                               origin : str, dns_resolvers : Dict[str, dns.asyncresolver.Resolver], concurrency : int,
+                               summaries : LatencySummaries, store : Literal['parquet', 'csv'] = 'parquet', verbose : bool = False):
+    latencies = await time_domains(curr_sampled_df['domain'].tolist(), dns_resolvers, concurrency, verbose)
     
-    ranks = list(zip([1, 10000, 100000, 400000], [2000, 12000, 102000, 402000]))
-    ranking_dfs_lst = prepare_ranking_dfs(args.origin, ranks)
+    await asyncio.to_thread(store_iteration, curr_sampled_df, curr_ranks, iteration, origin, latencies, summaries, store)
+
+
+async def run_schedule(args, ranks : List[Tuple[int, int]], ranking_dfs_lst : List[pd.DataFrame]):
+    """
+    Starts an iteration every args.interval seconds on the monotonic clock, regardless of how long the previous ones take,
+    so slow iterations overlap the next ones instead of delaying them.
+    The first iteration to fail stops the schedule: the running ones are cancelled and its exception is raised.
+    """
+    dns_resolvers = {dns_server : create_dns_resolver(dns_server, args.stub_port) for dns_server in args.dns_server}
+    summaries = LatencySummaries(SUMMARIES_PATH)
     
+    loop = asyncio.get_running_loop()
     rand_gen = default_rng()
+    running = set()
+    failures = []
+    failed = asyncio.Event()
+    
+    def iteration_done(task : asyncio.Task):
+        running.discard(task)
+        if (not task.cancelled() and task.exception() is not None):
+            failures.append(task.exception())
+            failed.set()
+    
+    start_time = loop.time()
     iteration = 0
     
-    while (True):
+    while ((args.iterations is None or iteration < args.iterations) and not failed.is_set()):
+        try:
+            await asyncio.wait_for(failed.wait(), max(0, start_time + iteration * args.interval - loop.time()))
+            break
+        except asyncio.TimeoutError:
+            pass
+        
         curr_ranking_df = ranking_dfs_lst[iteration % len(ranking_dfs_lst)]
         curr_ranks = ranks[iteration % len(ranking_dfs_lst)]
         indeces = rand_gen.choice(len(curr_ranking_df), size=args.batch_size, replace=False)
         
         curr_sampled_df = curr_ranking_df.iloc[indeces].copy(deep=True)
         
-        run_timing_iteration(curr_sampled_df, curr_ranks, iteration, args.origin, args.dns_server)
+        task = asyncio.create_task(run_timing_iteration(curr_sampled_df, curr_ranks, iteration, args.origin, dns_resolvers,
+                                                        args.concurrency, summaries, args.store, args.verbose))
+        running.add(task)
+        task.add_done_callback(iteration_done)
         
-        sleep(60)
         iteration += 1
+    
+    failed_waiter = asyncio.create_task(failed.wait())
+    while (running and not failed.is_set()):
+        await asyncio.wait(running | {failed_waiter}, return_when=asyncio.FIRST_COMPLETED)
+    failed_waiter.cancel()
+    
+    if (failed.is_set()):
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        raise failures[0]
+
+
+def main():
+    args = parse_arguments()
+    
+    if (args.download):
+        if (args.origin == 'alexa'):
+            download_alexa_top_entries_if_needed()
+        else:
+            download_umbrella_top_entries_if_needed()
+    
+    ranks = list(zip([1, 10000, 100000, 400000], [2000, 12000, 102000, 402000]))
+    ranking_dfs_lst = prepare_ranking_dfs(args.origin, ranks)
+    
+    stub_process = start_stub_dns_server(args.stub_port, args.stub_delay) if 'local_stub' in args.dns_server else None
+    try:
+        asyncio.run(run_schedule(args, ranks, ranking_dfs_lst))
+    finally:
+        if (stub_process is not None):
+            stub_process.terminate()
+            stub_process.join()
             
     
 if __name__ == '__main__':
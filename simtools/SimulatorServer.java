@@ -0,0 +1,44 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.Method;
+
+import com.typesafe.config.ConfigFactory;
+
+/**
+ * A long lived simulator process used by simtools (see daemon.py).
+ * <p>
+ * Every line read from stdin is the path of a config file to simulate. The file is installed as
+ * {@code config.file}, the config caches are dropped and the simulator's main is invoked in this JVM,
+ * so the JIT warmup is shared between runs. Once a run completes a {@code simtools-done <status>} line
+ * is written to stdout, on a line of its own even if the simulator's output did not end with a newline.
+ * The simulator's main is expected to return only after its report is written, daemon.py checks that it is not empty.
+ * <p>
+ * Launched as a single source file program: {@code java -cp <simulator classpath> SimulatorServer.java <main class>}
+ */
+public final class SimulatorServer {
+  private static final String DONE = "simtools-done ";
+
+  public static void main(String[] args) throws Exception {
+    Method simulator = Class.forName(args[0]).getMethod("main", String[].class);
+    PrintStream protocol = new PrintStream(new FileOutputStream(FileDescriptor.out), true);
+    BufferedReader requests = new BufferedReader(new InputStreamReader(System.in));
+
+    for (String path; (path = requests.readLine()) != null;) {
+      System.setProperty("config.file", path);
+      ConfigFactory.invalidateCaches();
+      int status = 0;
+      try {
+        simulator.invoke(null, (Object) new String[0]);
+      } catch (Throwable t) {
+        t.printStackTrace();
+        status = 1;
+      }
+      System.out.flush();
+      protocol.println();
+      protocol.println(DONE + status);
+    }
+  }
+}
@@ -0,0 +1,79 @@
+import atexit
+import os
+import subprocess
+
+server_source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SimulatorServer.java')
+classpath_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'classpath.gradle')
+simulator_main = 'com.github.benmanes.caffeine.cache.simulator.Simulator'
+classpath_prefix = 'SIMTOOLS_CLASSPATH='
+done_prefix = 'simtools-done '
+
+class SimulatorDaemon(object):
+    """
+    A long lived simulator JVM (see SimulatorServer.java).
+    Gradle is invoked once to compile the simulator and resolve its runtime classpath, after that every run
+    is a single line on the server's stdin, so the gradle handshake and the JIT warmup are paid only once.
+    """
+
+    def __init__(self, caffeine_root, gradle):
+        self.caffeine_root = caffeine_root
+        self.gradle = gradle
+        self.process = None
+
+    def classpath(self):
+        command = '{} -q -I {} simulator:simtoolsClasspath'.format(self.gradle, classpath_script)
+        output = subprocess.run(command, shell = True, cwd = self.caffeine_root, check = True,
+                                stdout = subprocess.PIPE, universal_newlines = True).stdout
+        for line in output.splitlines():
+            if line.startswith(classpath_prefix):
+                return line[len(classpath_prefix):]
+        raise RuntimeError('Could not resolve the simulator classpath')
+
+    def start(self):
+        self.process = subprocess.Popen(['java', '-cp', self.classpath(), server_source, simulator_main],
+                                        cwd = self.caffeine_root, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                        universal_newlines = True, bufsize = 1)
+
+    def run(self, conf_file, verbose=False, report_output=None):
+        """
+        Simulate the given config file and return the exit code of the run.
+        A run that succeeds without writing anything to its report_output (if given) fails with exit code 1.
+        """
+        if not self.process or self.process.poll() is not None:
+            self.start()
+        self.process.stdin.write(conf_file + '\n')
+        self.process.stdin.flush()
+        for line in self.process.stdout:
+            # the marker is looked for anywhere in the line, in case the simulator's output did not end with a newline
+            index = line.find(done_prefix)
+            if index >= 0:
+                if verbose and index > 0:
+                    print(line[:index])
+                status = int(line[index + len(done_prefix):])
+                if status == 0 and report_output and not (os.path.isfile(report_output) and os.path.getsize(report_output) > 0):
+                    return 1
+                return status
+            if verbose:
+                print(line, end='')
+        return self.process.wait()
+
+    def close(self):
+        if self.process and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+_daemon = None
+_daemon_pid = None
+
+def simulator_daemon(caffeine_root, gradle):
+    """
+    The simulator daemon of the current process, started on first use.
+    Worker processes of a sweep never share the daemon of their parent, each of them starts its own.
+    """
+    global _daemon, _daemon_pid
+    if _daemon is None or _daemon_pid != os.getpid():
+        _daemon = SimulatorDaemon(caffeine_root, gradle)
+        _daemon_pid = os.getpid()
+        atexit.register(_daemon.close)
+    return _daemon
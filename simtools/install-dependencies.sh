@@ -1,2 +1,3 @@
 pip install fire
 pip install pyhocon
+pip install numpy
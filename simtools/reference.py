@@ -0,0 +1,130 @@
+import heapq
+from collections import OrderedDict
+
+import numpy as np
+
+never = np.iinfo(np.int64).max
+
+def previous_use(keys):
+    """
+    For every request, the index of the previous request to the same key or -1 if there is none.
+    """
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind='stable')
+    ordered = keys[order]
+    previous = np.full(len(keys), -1, dtype=np.int64)
+    same = ordered[1:] == ordered[:-1]
+    previous[order[1:][same]] = order[:-1][same]
+    return previous
+
+def next_use(keys):
+    """
+    For every request, the index of the next request to the same key or never if there is none.
+    """
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind='stable')
+    ordered = keys[order]
+    following = np.full(len(keys), never, dtype=np.int64)
+    same = ordered[1:] == ordered[:-1]
+    following[order[:-1][same]] = order[1:][same]
+    return following
+
+def stack_distances(keys):
+    """
+    The LRU stack distance of every request: the number of distinct keys requested since the previous request
+    to the same key, or -1 for a first request. A request j in between is the first of its key there
+    when its previous request p' is at or before the previous request p, so the distance is
+    #{j < i : p' <= p} - (p + 1). These dominance counts are computed offline for all the requests at once,
+    one level per bit of the request index: at every level the requests of the lower half of each block
+    are sorted by their previous request, and the requests of the upper half count theirs with a binary search.
+    """
+    previous = previous_use(keys)
+    n = len(previous)
+    requests = np.arange(n, dtype=np.int64)
+    queries = np.flatnonzero(previous >= 0)
+    bounds = previous[queries] + 1
+    span = n + 1
+    counts = np.zeros(len(queries), dtype=np.int64)
+    for level in range(max(n - 1, 0).bit_length()):
+        lower = (requests >> level) & 1 == 0
+        ordered = np.sort((requests[lower] >> (level + 1)) * span + previous[lower] + 1)
+        upper = (queries >> level) & 1 == 1
+        blocks = queries[upper] >> (level + 1)
+        # the lower halves of the blocks before this one are full, so this block's start in ordered is blocks << level
+        counts[upper] += np.searchsorted(ordered, blocks * span + bounds[upper], side='right') - (blocks << level)
+    distances = np.full(n, -1, dtype=np.int64)
+    distances[queries] = counts - bounds
+    return distances
+
+def lru_hit_rates(keys, sizes):
+    """
+    The LRU hit rate (in percent) of every cache size, all of them from a single scan of the trace.
+    """
+    distances = stack_distances(keys)
+    distances = np.sort(distances[distances >= 0])
+    hits = np.searchsorted(distances, sizes, side='left')
+    return { size : 100.0 * hit / len(keys) for size, hit in zip(sizes, hits.tolist()) }
+
+def lfu_hit_rate(keys, size):
+    """
+    The hit rate (in percent) of an in-cache LFU that evicts the oldest of its least frequently used keys.
+    """
+    frequency = {}
+    buckets = {}
+    lowest = 0
+    hits = 0
+    for key in np.asarray(keys).tolist():
+        count = frequency.get(key)
+        if count is not None:
+            hits += 1
+            del buckets[count][key]
+            if not buckets[count]:
+                del buckets[count]
+                if lowest == count:
+                    lowest = count + 1
+            count += 1
+        else:
+            if len(frequency) >= size:
+                victim, _ = buckets[lowest].popitem(last=False)
+                if not buckets[lowest]:
+                    del buckets[lowest]
+                del frequency[victim]
+            count = lowest = 1
+        frequency[key] = count
+        buckets.setdefault(count, OrderedDict())[key] = None
+    return 100.0 * hits / len(keys)
+
+def opt_hit_rate(keys, size):
+    """
+    The hit rate (in percent) of Belady's clairvoyant policy, evicting the key whose next request is the furthest.
+    """
+    following = next_use(keys).tolist()
+    cache = {}
+    heap = []
+    hits = 0
+    for key, next_request in zip(np.asarray(keys).tolist(), following):
+        if key in cache:
+            hits += 1
+        cache[key] = next_request
+        heapq.heappush(heap, (-next_request, key))
+        if len(cache) > size:
+            while True:
+                next_victim, victim = heapq.heappop(heap)
+                if cache.get(victim) == -next_victim:
+                    del cache[victim]
+                    break
+    return 100.0 * hits / len(keys)
+
+def hit_rates(policy, keys, sizes):
+    """
+    The hit rates of lru, lfu or opt for the given cache sizes, as {size : hit rate}.
+    Only lru is vectorized, from a single scan for all the sizes; lfu and opt are not stack algorithms,
+    so they are simulated request by request once per size and take seconds per million requests each.
+    """
+    if policy == 'lru':
+        return lru_hit_rates(keys, sizes)
+    if policy == 'lfu':
+        return { size : lfu_hit_rate(keys, size) for size in sizes }
+    if policy == 'opt':
+        return { size : opt_hit_rate(keys, size) for size in sizes }
+    raise ValueError('No reference implementation for {}'.format(policy))
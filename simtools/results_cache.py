@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import warnings
+from functools import lru_cache
+
+# Bumped whenever reports stored by earlier versions cannot be trusted,
+# version 2 drops the reports that parallel runs could have stored from another run's csv
+report_version = 2
+
+class ResultsCache(object):
+    """
+    A content addressed store of simulator reports.
+    A report is keyed by a hash of the effective simulator config, the content of the trace files
+    and the caffeine revision, so a change to any of them can never be answered by a stale report.
+    Without a caffeine revision, i.e. when caffeine_root is not a git checkout, nothing is cached.
+    """
+
+    def __init__(self, db_path, caffeine_root):
+        self.db_path = db_path
+        self.caffeine_root = caffeine_root
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, report TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS traces (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT)')
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def trace_digest(self, path):
+        """
+        The sha256 of a trace file, recomputed only when the file's size or modification time change.
+        """
+        if not os.path.isfile(path):
+            return 'missing:' + path
+        stat = os.stat(path)
+        with self.connect() as db:
+            row = db.execute('SELECT digest FROM traces WHERE path = ? AND size = ? AND mtime = ?',
+                             (path, stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            return row[0]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO traces VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def key(self, conf):
+        """
+        The key of the report of the given config, or None when its caffeine revision is unknown and it cannot be cached.
+        """
+        revision = caffeine_revision(self.caffeine_root)
+        if revision is None:
+            return None
+        plain = conf.as_plain_ordered_dict()
+        simulator = plain['caffeine']['simulator']
+        simulator.pop('report', None)
+        simulator['files']['paths'] = [ self.trace_digest(path) for path in simulator['files']['paths'] ]
+        content = json.dumps({ 'conf' : plain, 'revision' : revision, 'version' : report_version }, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key):
+        with self.connect() as db:
+            row = db.execute('SELECT report FROM results WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, report):
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)', (key, report))
+
+@lru_cache(maxsize=None)
+def caffeine_revision(caffeine_root):
+    """
+    The checked out caffeine commit, together with a hash of any uncommitted changes to it,
+    or None (with a warning) when it cannot be read from git.
+    """
+    def git(*args):
+        return subprocess.run(['git'] + list(args), cwd = caffeine_root, stdout = subprocess.PIPE,
+                              stderr = subprocess.DEVNULL, universal_newlines = True)
+    head = git('rev-parse', 'HEAD')
+    diff = git('diff', 'HEAD')
+    if head.returncode != 0 or diff.returncode != 0:
+        warnings.warn('{} is not a git checkout, the simulator results are not cached'.format(caffeine_root))
+        return None
+    revision = head.stdout.strip()
+    diff = diff.stdout
+    if diff:
+        revision += '+' + hashlib.sha256(diff.encode()).hexdigest()
+    return revision
@@ -0,0 +1,52 @@
+import numpy as np
+
+from reference import stack_distances, lru_hit_rates
+
+sampling_modulus = 1 << 24
+
+def hash_keys(keys):
+    """
+    A vectorized splitmix64 finalizer, spreading the keys uniformly over the 64 bit space.
+    """
+    z = np.asarray(keys, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+class MissRatioCurve(object):
+    """
+    An LRU miss ratio curve estimated with SHARDS (Waldspurger et al., FAST '15).
+    Only the keys whose hash falls under rate * modulus are simulated, so every key is either always or never sampled,
+    and the stack distances of the sampled requests are scaled back by 1 / rate.
+    """
+
+    def __init__(self, keys, rate=0.01, adjust=True):
+        keys = np.asarray(keys)
+        self.rate = rate
+        self.requests = len(keys)
+        sampled = keys[hash_keys(keys) % np.uint64(sampling_modulus) < np.uint64(int(rate * sampling_modulus))]
+        self.samples = len(sampled)
+        distances = stack_distances(sampled)
+        self.distances = np.sort(distances[distances >= 0]) / rate
+        self.expected = rate * self.requests
+        # SHARDS_adj: the difference between the expected and the actual number of samples is credited to the first bucket
+        self.adjustment = self.expected - self.samples if adjust else 0
+
+    def miss_ratios(self, sizes):
+        sizes = np.asarray(sizes)
+        hits = np.searchsorted(self.distances, sizes, side='left') + np.where(sizes > 0, self.adjustment, 0)
+        return np.clip(1 - hits / self.expected, 0, 1) if self.expected else np.ones(len(sizes))
+
+    def curve(self):
+        """
+        The whole estimated curve as (sizes, miss ratios), one point per distinct scaled stack distance.
+        """
+        sizes = np.unique(np.ceil(self.distances + 1)).astype(np.int64)
+        return sizes, self.miss_ratios(sizes)
+
+def accuracy(mrc, keys, sizes):
+    """
+    Compare the estimated miss ratios with exact LRU miss ratios, returns {size : (exact, estimated)}.
+    """
+    exact = lru_hit_rates(keys, sizes)
+    return { size : (1 - exact[size] / 100, estimated) for size, estimated in zip(sizes, mrc.miss_ratios(sizes).tolist()) }
@@ -1,5 +1,10 @@
 from traces import *
 from policies import *
+from daemon import simulator_daemon
+from results_cache import ResultsCache
+from trace_reader import load_trace
+from reference import hit_rates as reference_hit_rates
+from shards import MissRatioCurve, accuracy as mrc_accuracy
 import fire
 import urllib
 import os
@@ -14,6 +19,10 @@ from enum import Enum
 from pprint import pprint
 import matplotlib.pyplot as plt
 import pickle
+import numpy as np
+import tempfile
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 with open(os.path.join(os.path.dirname(__file__), 'conf.json')) as conf_file:
     local_conf = json.load(conf_file)
@@ -21,64 +30,224 @@ caffeine_root = local_conf['caffeine_root']
 resources_path = local_conf['resources'] if local_conf['resources'] else caffeine_root + 'simulator{0}src{0}main{0}resources{0}com{0}github{0}benmanes{0}caffeine{0}cache{0}simulator{0}parser{0}'.format(os.sep)
 output_path = local_conf['output'] if local_conf['output'] else os.getcwd() + os.sep
 output_csvs_path = output_path + 'csvs' + os.sep
+output_traces_path = output_path + 'traces' + os.sep
+base_conf_file = caffeine_root + 'simulator{0}src{0}main{0}resources{0}application.conf'.format(os.sep)
+gradle = './gradlew -x caffeine:compileJava -x caffeine:compileCodeGenJava'
+# gradle = './gradlew'
+run_simulator = gradle + ' simulator:run'
 
 class Admission(Enum):
     ALWAYS = 'Always'
     TINY_LFU = 'TinyLfu'
 
-def single_run(policy, trace, size=4, changes={}, name=None, save=True, reuse=False, verbose=False, readonly=False):
-    name = name if name else policy
-    policy = Policy[policy]
-    trace = Trace[trace]
-    if 0 < size < 9:
-        size = trace.typical_caches()[size-1]
-    conf_path = caffeine_root + 'simulator{0}src{0}main{0}resources{0}'.format(os.sep)
-    conf_file = conf_path + 'application.conf'
-    if not os.path.exists(output_csvs_path):
-        os.makedirs(output_csvs_path)
-    run_simulator = './gradlew simulator:run -x caffeine:compileJava -x caffeine:compileCodeGenJava'
-#   run_simulator = './gradlew simulator:run'
-    if os.path.exists(conf_file):
-        conf = ConfigFactory.parse_file(conf_file)
-    else:
-        conf = ConfigFactory.parse_string("""
-                                          caffeine {
-                                            simulator {
-                                            }
-                                          }
-                                          """)
+def base_conf():
+    """
+    The shared application.conf of the simulator, used as a read-only template for the runs.
+    """
+    if os.path.exists(base_conf_file):
+        return ConfigFactory.parse_file(base_conf_file)
+    return ConfigFactory.parse_string("""
+                                      caffeine {
+                                        simulator {
+                                        }
+                                      }
+                                      """)
+
+def simulate(conf, verbose=False, daemon=False):
+    """
+    Run the simulator with the given configuration and return its exit code.
+    The configuration is written to a private file that is handed to the simulator JVM with -Dconfig.file,
+    so the shared application.conf is never modified and several runs can execute side by side.
+    With daemon the run is sent to this process' long lived simulator JVM instead of a new gradle invocation.
+    """
+    fd, conf_file = tempfile.mkstemp(prefix='simulator-', suffix='.conf')
+    with os.fdopen(fd, 'w') as f:
+        f.write(HOCONConverter.to_hocon(conf))
+    env = dict(os.environ)
+    env['JAVA_TOOL_OPTIONS'] = '{} -Dconfig.file={}'.format(env.get('JAVA_TOOL_OPTIONS', ''), conf_file).strip()
+    try:
+        if daemon:
+            report = conf.get_string('caffeine.simulator.report.output', 'console')
+            return simulator_daemon(caffeine_root, gradle).run(conf_file, verbose, report if report != 'console' else None)
+        return call(run_simulator, shell = True, cwd = caffeine_root, env = env, stdout = subprocess.DEVNULL if not verbose else None)
+    finally:
+        os.remove(conf_file)
+
+def trace_path(trace):
+    return resources_path + trace.format() + os.sep + trace.file()
+
+def load(trace):
+    """
+    The requests of a trace as memory mapped numpy columns, converted once into the traces directory of the output path.
+    """
+    return load_trace(trace, trace_path(trace), output_traces_path)
+
+def run_conf(policies, trace, size, changes, report_output=None):
+    conf = base_conf()
     simulator = conf['caffeine']['simulator']
-    simulator.put('files.paths', [ resources_path + trace.format() + os.sep + trace.file() ])
+    simulator.put('files.paths', [ trace_path(trace) ])
              
     simulator.put('files.format', trace.value['format'])
     simulator.put('maximum-size', size)
-    simulator.put('policies', [ policy.value ])
+    simulator.put('policies', [ policy.value for policy in policies ])
     simulator.put('admission', [ Admission.ALWAYS.value ])
     
-    if verbose:
+    if not report_output:
         simulator.put('report.format', 'table')
         simulator.put('report.output', 'console')
     else:
         simulator.put('report.format', 'csv')
-        simulator.put('report.output', output_csvs_path + '{}-{}-{}.csv'.format(trace.name,size,name))
+        simulator.put('report.output', report_output)
 
     for k,v in changes.items():
         simulator.put(k,v)
+    return conf
 
-    with open(conf_file, 'w') as f:
-        f.write(HOCONConverter.to_hocon(conf))
-    if (not reuse or not os.path.isfile(simulator['report']['output'])) and not readonly:
-        retcode = call(run_simulator, shell = True, cwd = caffeine_root, stdout = subprocess.DEVNULL if not verbose else None)
-        if (not retcode == 0):
-            return False
+def cell_csv(trace, size, name):
+    return output_csvs_path + '{}-{}-{}.csv'.format(trace.name,size,name)
+
+def read_report(report_file):
+    with open(report_file, 'r') as csvfile:
+        reader = csv.DictReader(csvfile)
+        results = { line['Policy'] : float(line['Hit Rate']) for line in reader }
+    return results if len(results) != 1 else list(results.values())[0]
+
+def split_report(report_file, outputs):
+    """
+    Split a combined csv report into a csv per policy.
+    outputs is a list of (policy, output file) pairs, a report row belongs to the policy with the longest matching name.
+    """
+    with open(report_file, 'r') as csvfile:
+        reader = csv.DictReader(csvfile)
+        fields = reader.fieldnames
+        rows = list(reader)
+    for policy, output in outputs:
+        with open(output, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fields)
+            writer.writeheader()
+            for row in rows:
+                owner = max((p for p, _ in outputs if row['Policy'].startswith(p.value)), key=lambda p: len(p.value), default=None)
+                if owner == policy:
+                    writer.writerow(row)
+
+@lru_cache(maxsize=None)
+def results_cache():
+    os.makedirs(output_path, exist_ok=True)
+    return ResultsCache(output_path + 'results.db', caffeine_root)
+
+def restore_report(key, report_output):
+    """
+    Write the cached report with the given key into report_output, returns whether such a report exists.
+    """
+    report = results_cache().get(key) if key else None
+    if report is None:
+        return False
+    with open(report_output, 'w') as f:
+        f.write(report)
+    return True
+
+def store_report(key, report_output):
+    """
+    Cache the report that a run wrote to its own private file.
+    A report without rows or with a repeated policy is not the output of a single run and is never stored.
+    """
+    with open(report_output, 'r') as f:
+        report = f.read()
+    policies = [ line['Policy'] for line in csv.DictReader(report.splitlines()) ]
+    if policies and len(policies) == len(set(policies)):
+        results_cache().put(key, report)
+
+def private_report(trace, size, name):
+    """
+    A fresh report file next to the cell csv, so concurrent runs of cells with the same name never share a file.
+    It is published to the cell csv with an atomic os.replace once its run is done.
+    """
+    fd, report_output = tempfile.mkstemp(prefix='{}-{}-{}-'.format(trace.name, size, name), suffix='.tmp', dir=output_csvs_path)
+    os.close(fd)
+    return report_output
+
+def publish_report(report_output, cell_output, save):
+    if save:
+        os.replace(report_output, cell_output)
+    else:
+        os.remove(report_output)
+
+def single_run(policy, trace, size=4, changes={}, name=None, save=True, reuse=False, verbose=False, readonly=False, daemon=False):
+    name = name if name else policy
+    policy = Policy[policy]
+    trace = Trace[trace]
+    if 0 < size < 9:
+        size = trace.typical_caches()[size-1]
+    os.makedirs(output_csvs_path, exist_ok=True)
+    report_output = private_report(trace, size, name) if not verbose else None
+    conf = run_conf([ policy ], trace, size, changes, report_output)
+    # the trace is only hashed when the cache is used
+    key = results_cache().key(conf) if reuse and not verbose else None
+
+    try:
+        if not reuse or not restore_report(key, report_output):
+            if readonly:
+                return read_report(cell_csv(trace, size, name)) if not verbose else None
+            retcode = simulate(conf, verbose, daemon)
+            if (not retcode == 0):
+                return False
+            if key:
+                store_report(key, report_output)
+        
+        if not verbose:
+            results = read_report(report_output)
+            publish_report(report_output, cell_csv(trace, size, name), save)
+            return results
+    finally:
+        if report_output and os.path.exists(report_output):
+            os.remove(report_output)
+
+def batch_run(policies, trace, size=4, changes={}, names=None, save=True, reuse=False, readonly=False, daemon=False):
+    """
+    Run all the given policies on a trace with a single simulator invocation, sharing the JVM startup and the trace parsing.
+    The combined report is split back into the per policy csvs that single_run would have written,
+    and the results are returned as a list in the order of the policies.
+    """
+    names = names if names else policies
+    policies = [ Policy[policy] for policy in policies ]
+    trace = Trace[trace]
+    if 0 < size < 9:
+        size = trace.typical_caches()[size-1]
+    os.makedirs(output_csvs_path, exist_ok=True)
+    outputs = [ cell_csv(trace, size, name) for name in names ]
+    reports = [ private_report(trace, size, name) for name in names ]
+    keys = [ results_cache().key(run_conf([ policy ], trace, size, changes)) if reuse else None for policy in policies ]
     
-    if not verbose:
-        with open(simulator['report']['output'], 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            results = { line['Policy'] : float(line['Hit Rate']) for line in reader }
-        if not save:
-            os.remove(simulator['report']['output'])
-        return results if len(results) != 1 else list(results.values())[0]
+    try:
+        pending = [ i for i in range(len(policies)) if not reuse or not restore_report(keys[i], reports[i]) ]
+        if readonly:
+            # the results that are not cached are read from the csvs of earlier runs
+            for i in pending:
+                reports[i] = outputs[i]
+        elif pending:
+            fd, report_output = tempfile.mkstemp(prefix='{}-{}-batch-'.format(trace.name, size), suffix='.csv', dir=output_csvs_path)
+            os.close(fd)
+            conf = run_conf([ policies[i] for i in pending ], trace, size, changes, report_output)
+            try:
+                retcode = simulate(conf, daemon=daemon)
+                if (not retcode == 0):
+                    return [False]*len(policies)
+                split_report(report_output, [ (policies[i], reports[i]) for i in pending ])
+                for i in pending:
+                    if keys[i]:
+                        store_report(keys[i], reports[i])
+            finally:
+                os.remove(report_output)
+        
+        results = [ read_report(report) for report in reports ]
+        for report, output in zip(reports, outputs):
+            if report != output:
+                publish_report(report, output, save)
+        return results
+    finally:
+        for report, output in zip(reports, outputs):
+            if report != output and os.path.exists(report):
+                os.remove(report)
 
 def download_single_trace(trace, path=None):
         if not path:
@@ -100,12 +269,46 @@ def parse_traces(traces):
         return [ Trace[trace] for trace in traces ]
     return []
 
-def rf_rank(trace, size):
-    lru = single_run('lru', trace.name, size, save=True, reuse=True)
-    lfu = single_run('lfu', trace.name, size, save=True, reuse=True)
-    opt = single_run('opt', trace.name, size, save=True, reuse=True)
+rf_policies = ['lru', 'lfu', 'opt']
+
+def rf_cells(trace, size, daemon=False):
+    return [ (policy, trace.name, size, {}, None, True, True, False, False, daemon) for policy in rf_policies ]
+
+@lru_cache(maxsize=None)
+def native_hit_rates(policy, trace):
+    """
+    The hit rates of lru, lfu or opt on all the typical cache sizes of a trace, computed in process by reference.py.
+    """
+    return reference_hit_rates(policy, load(trace).keys, trace.typical_caches())
+
+def native_rf(trace, size):
+    return [ native_hit_rates(policy, trace)[trace.typical_caches()[size-1]] for policy in rf_policies ]
+
+def rf_rank(trace, size, jobs=1, daemon=False, native=False):
+    lru, lfu, opt = native_rf(trace, size) if native else sweep(rf_cells(trace, size, daemon), jobs)
     return (lru-lfu)/opt 
 
+def sweep(cells, jobs=1, run=single_run):
+    """
+    Run every cell (a tuple of arguments for run) and yield the results in the order of the cells.
+    When jobs > 1 the cells are executed concurrently by a pool of worker processes.
+    """
+    if jobs <= 1 or not cells:
+        for cell in cells:
+            yield run(*cell)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(run, *zip(*cells))
+
+def batch_groups(changes):
+    """
+    Group the indices of the policies that share the same changes, each group can be simulated by a single batch_run.
+    """
+    groups = {}
+    for i, change in enumerate(changes):
+        groups.setdefault(json.dumps(change, sort_keys=True), []).append(i)
+    return list(groups.values())
+
 class Tools(object):
 
     def download_traces(self, traces=None, path=None):
@@ -117,6 +320,14 @@ class Tools(object):
         for trace in traces:
             download_single_trace(trace, path)
 
+    def cache_traces(self, traces=None):
+        """
+        Convert the given traces (all of them by default) into the binary columnar cache used by the python side tools.
+        """
+        for trace in parse_traces(traces):
+            data = load(trace)
+            print('{} cached with {:,} requests'.format(trace.name, len(data.keys)))
+
     def list_traces(self, sizes=False):
         """
         Print all the avaliable traces.
@@ -141,15 +352,75 @@ class Tools(object):
             print(text.format(*texts))
         print(line)
 
-    def run(self, policy, trace, size=4, changes={}, name=None, save=True, reuse=False, verbose=False):
-        res = single_run(policy, trace, size, changes, name, save, reuse, verbose)
+    def reference(self, policy, trace):
+        """
+        Print the hit rates of lru, lfu or opt on all the typical cache sizes of a trace, computed in process without the simulator.
+        """
+        trace = Trace[trace]
+        for size, hit_rate in native_hit_rates(policy, trace).items():
+            print('The hit rate of {} on {} with cache size of {} is: {:2.2f}%'.format(policy, trace.name, size, hit_rate))
+
+    def mrc(self, trace, rate=0.01, points=16, max_size=None, exact=False, save=False):
+        """
+        Print the LRU miss ratio curve of a trace, estimated with SHARDS spatial sampling at the given rate,
+        over geometrically spaced cache sizes up to max_size (twice the largest typical cache size by default).
+        With --exact the estimate is compared against exact LRU at the typical cache sizes,
+        and --save writes the whole estimated curve to a csv.
+        """
+        trace = Trace[trace]
+        keys = load(trace).keys
+        mrc = MissRatioCurve(keys, rate)
+        max_size = max_size if max_size else 2 * trace.typical_caches()[-1]
+        sizes = np.unique(np.geomspace(1, max_size, points).astype(np.int64))
+        print('SHARDS sampled {:,} of {:,} requests'.format(mrc.samples, mrc.requests))
+
+        line = ' ' + '-'*(16 * 2 - 1)
+        text ='|' + '{:^15}|'*2
+        print(line)
+        print(text.format('Cache Size', 'Miss Ratio'))
+        print(line)
+        for size, miss_ratio in zip(sizes.tolist(), mrc.miss_ratios(sizes).tolist()):
+            print(text.format(size, '{:2.2f}%'.format(100 * miss_ratio)))
+        print(line)
+
+        if exact:
+            line = ' ' + '-'*(16 * 4 - 1)
+            text ='|' + '{:^15}|'*4
+            print(line)
+            print(text.format('Cache Size', 'Exact', 'SHARDS', 'Error'))
+            print(line)
+            errors = []
+            for size, (exact_ratio, estimated_ratio) in mrc_accuracy(mrc, keys, trace.typical_caches()).items():
+                errors.append(abs(exact_ratio - estimated_ratio))
+                print(text.format(size, '{:2.2f}%'.format(100 * exact_ratio), '{:2.2f}%'.format(100 * estimated_ratio), '{:2.2f}%'.format(100 * errors[-1])))
+            print(line)
+            print(text.format('', '', 'Mean Error:', '{:2.2f}%'.format(100 * sum(errors) / len(errors))))
+            print(line)
+
+        if save:
+            os.makedirs(output_csvs_path, exist_ok=True)
+            curve_sizes, curve_ratios = mrc.curve()
+            with open(output_csvs_path + '{}-mrc-{}.csv'.format(trace.name, rate), 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(['Cache Size', 'Miss Ratio'])
+                writer.writerows(zip(curve_sizes.tolist(), curve_ratios.tolist()))
+
+    def run(self, policy, trace, size=4, changes={}, name=None, save=True, reuse=False, verbose=False, daemon=False):
+        res = single_run(policy, trace, size, changes, name, save, reuse, verbose, daemon=daemon)
         print('The hit rate of {} on {} with cache size of {} is: {}%'
                 .format(name if name else policy, trace, size if size > 8 else Trace[trace].typical_caches()[size-1], res))
 
-    def battle(self, policy1, policy2, changes1={}, changes2={}, name1=None, name2=None, save=True, reuse=False, verbose=False, rfo=False, filt=None, losers=False):
-        self.compare(policies=[policy1, policy2], changes=[changes1, changes2], names=[name1, name2], save=save, reuse=reuse, verbose=verbose, rfo=rfo, filt=filt, losers=losers)
+    def battle(self, policy1, policy2, changes1={}, changes2={}, name1=None, name2=None, save=True, reuse=False, verbose=False, rfo=False, filt=None, losers=False, jobs=1, batch=False, daemon=False, native=False):
+        self.compare(policies=[policy1, policy2], changes=[changes1, changes2], names=[name1, name2], save=save, reuse=reuse, verbose=verbose, rfo=rfo, filt=filt, losers=losers, jobs=jobs, batch=batch, daemon=daemon, native=native)
 
-    def compare(self, policies, changes=None, names=None, save=True, reuse=False, verbose=False, rfo=False, filt=None, losers=False):
+    def compare(self, policies, changes=None, names=None, save=True, reuse=False, verbose=False, rfo=False, filt=None, losers=False, jobs=1, batch=False, daemon=False, native=False):
+        """
+        Compare the hit rates of the given policies over all the traces and their typical cache sizes.
+        Use --jobs N to run up to N independent simulations concurrently,
+        and --batch to run all the policies sharing the same changes in a single simulator invocation (ignored when verbose).
+        Use --daemon to send the runs to a long lived simulator JVM (one per job) instead of invoking gradle for each of them.
+        With --native the (LRU-LFU)/OPT column of --rfo is computed in process by the python reference simulators.
+        """
         if not changes or not changes[0]:
             changes = [{}]*len(policies)
         if not names or not names[0]:
@@ -164,32 +435,60 @@ class Tools(object):
         print(text.format(*headers, *names, 'Difference'))
         print(line)
 
-        for trace in Trace:
-            for size in range(1,1+8):
-                policies_hr = [ single_run(policy, trace.name, size, change, name, save, reuse, verbose) \
-                                for policy, change, name in zip(policies, changes, names)]
-                texts = [trace.name, trace.typical_caches()[size-1]] + (['{:2.2f}'.format(rf_rank(trace, size))] if rfo else []) + \
-                        ['{:2.2f}%'.format(policy_hr) for policy_hr in policies_hr] + ['{:2.2f}%'.format(max(policies_hr)-min(policies_hr))]
-
-                if (filt and (abs(min(policies_hr) - max(policies_hr)) < filt)):
-                    continue
-
-                min_index = policies_hr.index(min(policies_hr))
-                max_index = policies_hr.index(max(policies_hr))
-                
-                offset = 2 + (1 if rfo else 0)
-                if not losers:
-                    texts[offset + min_index] = ''
-                texts[offset + max_index] = '\N{CHECK MARK} ' + texts[offset + max_index] 
-
-                if min_index == max_index and not losers:
-                    for i in range(len(policies_hr)):
-                        texts[offset + i] = ''
-
-                print(text.format(*texts))
-
-                if min_index != max_index:
-                    policies_wins[max_index] += 1
+        rows = [ (trace, size) for trace in Trace for size in range(1,1+8) ]
+        batch = batch and not verbose
+        simulated_rf = rfo and not native
+        groups = batch_groups(changes)
+        cells = []
+        for trace, size in rows:
+            if batch:
+                cells += [ ([ policies[i] for i in group ], trace.name, size, changes[group[0]], [ names[i] for i in group ], save, reuse, False, daemon) \
+                           for group in groups ]
+                if simulated_rf:
+                    cells.append((rf_policies, trace.name, size, {}, None, True, True, False, daemon))
+            else:
+                cells += [ (policy, trace.name, size, change, name, save, reuse, verbose, False, daemon) \
+                           for policy, change, name in zip(policies, changes, names) ]
+                if simulated_rf:
+                    cells += rf_cells(trace, size, daemon)
+        results = sweep(cells, jobs, batch_run if batch else single_run)
+
+        for trace, size in rows:
+            if batch:
+                policies_hr = [None]*len(policies)
+                for group in groups:
+                    for i, hr in zip(group, next(results)):
+                        policies_hr[i] = hr
+                if simulated_rf:
+                    lru, lfu, opt = next(results)
+            else:
+                policies_hr = [ next(results) for policy in policies ]
+                if simulated_rf:
+                    lru, lfu, opt = [ next(results) for i in range(3) ]
+            if rfo and native:
+                lru, lfu, opt = native_rf(trace, size)
+            texts = [trace.name, trace.typical_caches()[size-1]] + (['{:2.2f}'.format((lru-lfu)/opt)] if rfo else []) + \
+                    ['{:2.2f}%'.format(policy_hr) for policy_hr in policies_hr] + ['{:2.2f}%'.format(max(policies_hr)-min(policies_hr))]
+
+            if (filt and (abs(min(policies_hr) - max(policies_hr)) < filt)):
+                continue
+
+            min_index = policies_hr.index(min(policies_hr))
+            max_index = policies_hr.index(max(policies_hr))
+            
+            offset = 2 + (1 if rfo else 0)
+            if not losers:
+                texts[offset + min_index] = ''
+            texts[offset + max_index] = '\N{CHECK MARK} ' + texts[offset + max_index] 
+
+            if min_index == max_index and not losers:
+                for i in range(len(policies_hr)):
+                    texts[offset + i] = ''
+
+            print(text.format(*texts))
+
+            if min_index != max_index:
+                policies_wins[max_index] += 1
 
         print(line)
         print(text.format(*(['']*(1 + (1 if rfo else 0))),'Total Wins:', *policies_wins, ''))
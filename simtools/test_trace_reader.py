@@ -0,0 +1,26 @@
+import lzma
+
+import numpy as np
+
+from traces import Trace
+from trace_reader import latency_record, load_trace
+
+def write_binary_trace(path, records):
+    with lzma.open(path, 'wb') as f:
+        f.write(records.tobytes())
+
+def test_load_latency_binary(tmp_path):
+    records = np.zeros(5, dtype=latency_record)
+    records['key'] = [7, 2**63 + 1, 7, 3, 2**64 - 1]
+    records['hit_penalty'] = 1
+    records['delay'] = [10.5, 200, 11, 0.25, 3000]
+    records['mean'] = 50
+    path = str(tmp_path / Trace.l_normal_single_32_binary.file())
+    write_binary_trace(path, records)
+
+    for _ in range(2):
+        data = load_trace(Trace.l_normal_single_32_binary, path, str(tmp_path / 'cache'))
+        assert data.keys.dtype == np.uint64
+        assert data.keys.tolist() == records['key'].tolist()
+        assert data.hit_penalty.tolist() == [1] * 5
+        assert data.miss_penalty.tolist() == records['delay'].tolist()
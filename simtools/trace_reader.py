@@ -0,0 +1,190 @@
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import tarfile
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+TraceData = namedtuple('TraceData', ['keys', 'hit_penalty', 'miss_penalty'])
+
+umass_block_size = 512
+
+# Bumped whenever a reader changes the keys it produces, so the columnar caches of older versions are converted again
+cache_version = 2
+
+# The requests that the simulator's wikipedia reader skips, matched against the path of the url
+wikipedia_ignored_prefixes = (b'wiki/Special:Search', b'w/query.php', b'wiki/Talk:', b'wiki/Special:AutoLogin', b'Special:UserLogin',
+                              b'w/api.php', b'error:')
+wikipedia_ignored_tags = (b'?search=', b'&search=', b'User+talk', b'User_talk', b'User:', b'Talk:', b'&diff=', b'&action=rollback',
+                          b'Special:Watchlist')
+wikipedia_entities = ((b'%2F', b'/'), (b'%20', b' '), (b'&amp;', b'&'), (b'%3A', b':'), (b'%3B', b';'), (b'%3D', b'='), (b'%3F', b'?'))
+
+# The binary timed trace records written by timed-trace-gen/latency_appender.py --binary
+latency_record = np.dtype([('key', '<u8'), ('hit_penalty', '<f4'), ('delay', '<f4'), ('mean', '<f4')])
+
+def open_decompressed(path):
+    """
+    Open a trace file as a binary stream, transparently decompressing gzip, xz and bz2 files by their magic bytes.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.open(path, 'rb')
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        return lzma.open(path, 'rb')
+    if magic.startswith(b'BZh'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+def trace_streams(path):
+    """
+    Yield the binary streams holding the requests of a trace file, a (compressed) tar archive yields each of its members.
+    """
+    stream = io.BufferedReader(open_decompressed(path))
+    with stream:
+        header = stream.peek(512)[:512]
+        if len(header) == 512 and header[257:262] == b'ustar':
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield tar.extractfile(member)
+        else:
+            yield stream
+
+def lines(path):
+    for stream in trace_streams(path):
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield line
+
+def read_arc(path):
+    keys = array('Q')
+    for line in lines(path):
+        fields = line.split()
+        start = int(fields[0])
+        keys.extend(range(start, start + int(fields[1])))
+    return keys, None, None
+
+def read_lirs(path):
+    keys = array('Q', (int(line) for line in lines(path) if line.isdigit()))
+    return keys, None, None
+
+def read_umass_storage(path):
+    keys = array('Q')
+    for line in lines(path):
+        fields = line.split(b',')
+        if fields[3].lower().startswith(b'w'):
+            continue
+        start = int(fields[1])
+        blocks = -(-int(fields[2]) // umass_block_size)
+        keys.extend(range(start, start + blocks))
+    return keys, None, None
+
+def wikipedia_path(line):
+    """
+    The page requested by a wikibench line, as the simulator's wikipedia reader extracts it,
+    or None for the updates (whose save flag is not '-') and the ignored pages.
+    """
+    if not line.endswith(b'-'):
+        return None
+    start = line.find(b'http://')
+    if start < 0:
+        return None
+    end = line.find(b' ', start)
+    url = line[start:end] if end >= 0 else line[start:]
+    if len(url) <= 12:
+        return None
+    index = url.find(b'/', 7)
+    path = url
+    if index >= 0:
+        path = url[index + 1:]
+        for entity, replacement in wikipedia_entities:
+            path = path.replace(entity, replacement)
+    if path.startswith(wikipedia_ignored_prefixes) or any(tag in path for tag in wikipedia_ignored_tags):
+        return None
+    return path
+
+def read_wikipedia(path):
+    keys = array('Q')
+    for line in lines(path):
+        page = wikipedia_path(line)
+        if page is not None:
+            keys.append(int.from_bytes(hashlib.blake2b(page, digest_size=8).digest(), 'little'))
+    return keys, None, None
+
+def read_latency(path):
+    keys, hit_penalty, miss_penalty = array('Q'), array('f'), array('f')
+    for line in lines(path):
+        fields = line.split()
+        keys.append(int(fields[0]))
+        hit_penalty.append(float(fields[1]))
+        miss_penalty.append(float(fields[2]))
+    return keys, hit_penalty, miss_penalty
+
+def read_latency_binary(path):
+    records = np.concatenate([ np.frombuffer(stream.read(), dtype=latency_record) for stream in trace_streams(path) ])
+    return records['key'], records['hit_penalty'], records['delay']
+
+def read_scarab(path):
+    keys = np.concatenate([ np.frombuffer(stream.read(), dtype='>u8') for stream in trace_streams(path) ])
+    return keys.astype(np.uint64), None, None
+
+readers = {
+    'arc' : read_arc,
+    'lirs' : read_lirs,
+    'umass-storage' : read_umass_storage,
+    'wikipedia' : read_wikipedia,
+    'latency' : read_latency,
+    'latency-binary' : read_latency_binary,
+    'scarab' : read_scarab,
+}
+
+columns = [ ('keys', np.uint64), ('hit_penalty', np.float32), ('miss_penalty', np.float32) ]
+
+def convert_trace(trace_format, path, cache_dir):
+    """
+    Parse a trace once and store it in cache_dir as a .npy file per column.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for (name, dtype), values in zip(columns, readers[trace_format](path)):
+        column_file = os.path.join(cache_dir, name + '.npy')
+        if values is None:
+            if os.path.exists(column_file):
+                os.remove(column_file)
+            continue
+        np.save(column_file, np.frombuffer(values, dtype=dtype) if isinstance(values, array) else values.astype(dtype))
+    stat = os.stat(path)
+    with open(os.path.join(cache_dir, 'source.json'), 'w') as f:
+        json.dump({ 'path' : path, 'size' : stat.st_size, 'mtime' : stat.st_mtime, 'version' : cache_version }, f)
+
+def is_cached(path, cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'source.json')) as f:
+            source = json.load(f)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(path)
+    return source['size'] == stat.st_size and source['mtime'] == stat.st_mtime and source.get('version') == cache_version
+
+def load_trace(trace, path, cache_path):
+    """
+    Return the TraceData of a trace, with each column memory mapped from the columnar cache.
+    The trace text is parsed only the first time it is loaded, or when the trace file changes.
+    Wikipedia requests are filtered like the simulator does and their pages are hashed with blake2b,
+    so the keys differ from the simulator's but the requests and their identities are the same.
+    """
+    cache_dir = os.path.join(cache_path, trace.name)
+    if not is_cached(path, cache_dir):
+        convert_trace(trace.format(), path, cache_dir)
+    loaded = []
+    for name, _ in columns:
+        column_file = os.path.join(cache_dir, name + '.npy')
+        loaded.append(np.load(column_file, mmap_mode='r') if os.path.exists(column_file) else None)
+    return TraceData(*loaded)
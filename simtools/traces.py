@@ -41,6 +41,11 @@ class Trace(Enum):
     l_normal_single_1024    = { 'file' : 'wiki_single_1024_256.xz', 'format' : 'latency', 'typical_caches' : small_caches}
     l_uniform_single_50_150 = { 'file' : 'wiki_single_50_150U.xz', 'format' : 'latency', 'typical_caches' : small_caches}
 
+    # the same traces written by latency_appender.py --binary --compress, read by the python side tools only
+    l_normal_single_32_binary      = { 'file' : 'wiki_single_32_4.bin.xz', 'format' : 'latency-binary', 'typical_caches' : small_caches}
+    l_normal_single_1024_binary    = { 'file' : 'wiki_single_1024_256.bin.xz', 'format' : 'latency-binary', 'typical_caches' : small_caches}
+    l_uniform_single_50_150_binary = { 'file' : 'wiki_single_50_150U.bin.xz', 'format' : 'latency-binary', 'typical_caches' : small_caches}
+
     SCARAB_RECS_EX = { 'file' : 'recs.trace.20160808T073231Z.xz', 'format' : 'scarab', 'typical_caches' : medium_caches, 'extra_url' : 'http://download.scarabresearch.com/cache-traces/' }
 
     def file(self):
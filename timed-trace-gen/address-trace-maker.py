@@ -1,9 +1,12 @@
 import sys
-import random
 from functools import reduce
 import math
 from collections import Counter
 
+import numpy as np
+
+CHUNK_SIZE = 1000000
+
 read_times = {
     'HDD1':{
         'name':'WD VelociRaptor 1TB',
@@ -45,44 +48,43 @@ read_times = {
     }
 }
 
-def calc_thresholds(flag=False):
-    trace = 'input/' + sys.argv[1]
+def read_addresses(trace):
+    """
+    Parses the trace once into an int64 array of its addresses, in request order.
+    ARC lines are expanded to their blocks with array operations instead of range() per line.
+    """
+    with open(trace) as f:
+        if 'format=arc' in sys.argv:
+            # parsed straight into two int64 columns, without holding the split lines
+            starts, lengths = np.loadtxt(f, usecols=(0, 1), dtype=np.int64, ndmin=2).T
+            firsts = np.cumsum(lengths) - lengths
+            return np.repeat(starts - firsts, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+        if 'format=gradle' in sys.argv:
+            parse = lambda line: int(line.split()[0],16)
+        elif 'format=address' in sys.argv:
+            parse = lambda line: int(line.split()[1],16)
+        elif 'format=oltp' in sys.argv:
+            parse = lambda line: int(line.split(',')[1])
+        elif 'format=lirs' in sys.argv:
+            parse = int
+        else:
+            parse = lambda line: int(line.split()[-1],16)
+        return np.fromiter(map(parse, f), dtype=np.int64)
+
+def calc_thresholds(addresses, flag=False):
     portions = [int(p) for p in sys.argv[2].split('#')]
     s = sum(portions)
     fracs = [p/s for p in portions]
     fracs = [x+(sum(fracs[:i]) if i > 0 else 0) for i,x in zip(range(len(fracs)),fracs)]
     print(fracs)
-    addresses = set()
-    with open(trace) as f:
-        line = f.readline()
-        while line:
-            if 'format=gradle' in sys.argv:
-                address = [int(line.split()[0],16)]
-            elif 'format=address' in sys.argv:
-                address = [int(line.split()[1],16)]
-            elif 'format=arc' in sys.argv:
-                address = range(int(line.split()[0]),int(line.split()[0])+int(line.split()[1]))
-            elif 'format=oltp' in sys.argv:
-                address = [int(line.split(',')[1])]
-            elif 'format=lirs' in sys.argv:
-                address = [int(line)]
-            else:
-                address = [int(line.split()[-1],16)]
-            for a in address:
-                addresses.add(a)
-            line = f.readline()
-    addresses = list(addresses)
-    addresses.sort()
-    ths = [addresses[int(len(addresses)*f) if f<1.0 else -1] for f in fracs]
-    count = Counter()
-    for a in addresses:
-        for t in ths:
-            if a <= t:
-                count[str(t)] += 1
-                break
+    unique = np.unique(addresses)
+    ths = [int(unique[int(len(unique)*f) if f<1.0 else -1]) for f in fracs]
     if flag:
+        # the tier of every unique address is the first threshold that is not below it
+        tiers = np.searchsorted(ths, unique, side='left')
+        count = Counter({ str(t) : c for t, c in zip(ths, np.bincount(tiers, minlength=len(ths)).tolist()) if c })
         print('#'.join([str(t) for t in ths]))
-        print(len(addresses))
+        print(len(unique))
         print(count)
     else:
         return ths
@@ -90,57 +92,38 @@ def calc_thresholds(flag=False):
 
 if __name__ == "__main__":
     input_file = 'input/'+sys.argv[1]
-    ths = calc_thresholds()
+    all_addresses = read_addresses(input_file)
+    if len(all_addresses) == 0:
+        print('Error: missing format argument')
+        exit(1)
+    ths = calc_thresholds(all_addresses)
     drives = sys.argv[3].split('#')
     block_sizes = [4098]
     size_names = ['4kb']
     hps = ['1.1']
     if '-s' in sys.argv:
-        seed = sys.argv[sys.argv.index('-s') + 1]
+        seed = int(sys.argv[sys.argv.index('-s') + 1])
     else:
         seed = 27021990
-    random.seed(seed)
-    with open(input_file) as f:
-        for ext_name,block_size,hp in zip(size_names,block_sizes,hps):
-            hp = float(hp)
-            f.seek(0)
-            out_file = 'out_ths/%s'%ext_name+sys.argv[1]
-            with open(out_file,'w') as out:
-                line = f.readline()
-                while line:
-                    if 'format=gradle' in sys.argv:
-                        addresses = [int(line.split()[0],16)]
-                    elif 'format=address' in sys.argv:
-                        addresses = [int(line.split()[1],16)]
-                    elif 'format=arc' in sys.argv:
-                        addresses = range(int(line.split()[0]),int(line.split()[0])+int(line.split()[1]))
-                    elif 'format=oltp' in sys.argv:
-                        addresses = [int(line.split(',')[1])]
-                    elif 'format=lirs' in sys.argv:
-                        addresses = [int(line)]
-                    else:
-                        addresses = [int(line.split()[-1],16)]
-                    if not addresses:
-                        print('Error: missing format argument')
-                        exit(1)
-                    line = line.rstrip()
-                    for address in addresses:
-                        mpi = 0
-                        while mpi < len(ths) and address > ths[mpi]:
-                            mpi+=1
-                        drive = drives[mpi]
-                        min_read = read_times[drive]['min']
-                        max_read = read_times[drive]['max']
-                        avg_read = read_times[drive]['avg']
-                        read_rate = random.triangular(min_read,max_read,avg_read)
-                        mp = block_size/read_rate #gives miss penalty in microseconds
-                        if 'HDD' in drive:
-                            mp += read_times[drive]['rl']*1000 + read_times[drive]['st']*1000
-                        else:
-                            mp += read_times[drive]['st']
-                        flip = random.random()
-                        hit_time = hp*flip if flip > 0.95 else hp*(1.0+flip) if flip > 0.1 else hp*(2.0+flip) 
-                        out.write(str(address)+' %.2f %.2f'%(hit_time,mp)+'\n')
-                    line = f.readline()
+    rng = np.random.default_rng(seed)
+    # the read rate triangle and the fixed (seek + rotational) penalty of every drive, indexed by tier
+    min_reads = np.array([read_times[drive]['min'] for drive in drives])
+    max_reads = np.array([read_times[drive]['max'] for drive in drives])
+    avg_reads = np.array([read_times[drive]['avg'] for drive in drives])
+    fixed_penalties = np.array([read_times[drive]['rl']*1000 + read_times[drive]['st']*1000 if 'HDD' in drive
+                                else read_times[drive]['st'] for drive in drives])
+    for ext_name,block_size,hp in zip(size_names,block_sizes,hps):
+        hp = float(hp)
+        out_file = 'out_ths/%s'%ext_name+sys.argv[1]
+        with open(out_file,'w') as out:
+            for start in range(0, len(all_addresses), CHUNK_SIZE):
+                addresses = all_addresses[start:start + CHUNK_SIZE]
+                tiers = np.searchsorted(ths, addresses, side='left')
+                read_rates = rng.triangular(min_reads[tiers], avg_reads[tiers], max_reads[tiers])
+                mps = block_size/read_rates + fixed_penalties[tiers] #gives miss penalty in microseconds
+                flips = rng.random(len(addresses))
+                hit_times = hp*np.where(flips > 0.95, flips, np.where(flips > 0.1, 1.0+flips, 2.0+flips))
+                # a single write per chunk, formatting the lines directly is ~3x faster than np.savetxt
+                out.write(''.join(map('%d %.2f %.2f\n'.__mod__, zip(addresses.tolist(), hit_times.tolist(), mps.tolist()))))
     #TODO: add support for commpression 
     
@@ -4,126 +4,329 @@ from math import fsum, inf
 
 import argparse
 import datetime
-import tarfile
 import tqdm
 
 from os.path import *
-from os import path, listdir, makedirs
+from os import path, listdir, makedirs, sep
 
-from typing import Generator, List, Dict
+from typing import Generator, List
 
-from functools import reduce
+from abc import ABC, abstractmethod
+from functools import reduce, lru_cache
+from copy import copy
+from collections import deque
+from itertools import islice
+from multiprocessing import Process, Queue
+from queue import Empty, Full
+from collections import namedtuple
+from shutil import which
+from subprocess import Popen, PIPE
 
 from utils import Colors, Timer
+from sampling import AliasSampler
 from json import dump
+from csv import DictReader
 
 INPUT_DIR = './processed'
 OUTPUT_DIR = './out_latencies'
 
 RANDOM_BATCH_SIZE = 10000000
+MIN_BATCH_SIZE = 65536
+CHUNK_SIZE = 1000000
+FAN_OUT_QUEUE_SIZE = 4
+# Seconds between the liveness checks of the workers while waiting on their queues
+WORKER_POLL_INTERVAL = 1
+# The number of hash partitions of the key space in the seeded mode, fixed so the traces do not depend on the number of workers
+SEED_PARTITIONS = 64
 
-class NormalDist():
-    __slots__ = '_std_div', '_random_gen', 'mean', 'index', 'gen_values'
-    def __init__(self, mean: float, std_div: float):
-        self._std_div = std_div
-        self._random_gen = np.random.default_rng()
-        
-        self.mean = mean
+LATENCY_BINS = [0, 10, 100, 1000, 10000, inf]
 
-        self.refill_values()
+# A fixed width little endian record per request, the binary counterpart of the '{key} {hit_penalty} {delay} {mean}' text line
+TRACE_RECORD_DTYPE = np.dtype([('key', '<u8'), ('hit_penalty', '<f4'), ('delay', '<f4'), ('mean', '<f4')])
+BINARY_TRACE_EXTENSION = 'bin'
+# The raw little endian uint64 key files written by wiki-trace-parser.py --binary
+KEYS_EXTENSION = 'keys'
+
+class BatchedDist(ABC):
+    """
+    Hands out the values of a distribution from batches that are drawn in advance with a single vectorized call.
+    The first batch is only drawn on first use, and each batch is sized to the demand:
+    it starts at MIN_BATCH_SIZE and doubles on every refill, up to RANDOM_BATCH_SIZE (or the bounds given to spawn).
+    The batches are drawn from the given generator, which is shared by all the distributions of a run.
+    """
+    __slots__ = 'mean', 'index', 'gen_values', 'min_batch', 'max_batch', '_random_gen'
+    def __init__(self, mean: float, random_gen: np.random.Generator):
+        self.mean = mean
+        self.index = 0
+        self.gen_values = np.empty(0)
+        self.min_batch = MIN_BATCH_SIZE
+        self.max_batch = RANDOM_BATCH_SIZE
+        self._random_gen = random_gen
+    
+    @abstractmethod
+    def draw(self, size: int) -> np.ndarray:
+        """
+        Draws a batch of size values of the distribution.
+        """
     
-    def refill_values(self):
+    def use(self, random_gen: np.random.Generator):
+        """
+        Draws the next batches from the given generator, e.g. the one shared by the distributions of a worker process.
+        """
+        self._random_gen = random_gen
+    
+    def reseed(self, seed: np.random.SeedSequence):
+        """
+        Restarts the distribution from the stream of the given seed, dropping the values left in the current batch.
+        """
+        self._random_gen = np.random.default_rng(seed)
         self.index = 0
-        self.gen_values = self._random_gen.normal(self.mean, self._std_div, size=RANDOM_BATCH_SIZE)
+        self.gen_values = np.empty(0)
+    
+    def spawn(self, seed: np.random.SeedSequence, min_batch: int = MIN_BATCH_SIZE, max_batch: int = RANDOM_BATCH_SIZE) -> 'BatchedDist':
+        """
+        A copy of the distribution with its own stream, an empty batch and its own bounds on the batch size.
+        The parameters, e.g. the peaks' alias table or the empirical inverse CDF, are shared with the original.
+        """
+        child = copy(self)
+        child.reseed(seed)
+        child.min_batch = min_batch
+        child.max_batch = max_batch
+        return child
+    
+    def refill_values(self, demand: int = 0):
+        size = min(max(demand, 2 * len(self.gen_values), self.min_batch), self.max_batch)
+        self.index = 0
+        self.gen_values = self.draw(size)
+    
+    def take(self, n: int) -> np.ndarray:
+        """
+        Takes the next n values, refilling the batch as many times as needed.
+        """
+        parts = []
+        while n > 0:
+            if self.index >= len(self.gen_values):
+                self.refill_values(n)
+            
+            available = min(n, len(self.gen_values) - self.index)
+            parts.append(self.gen_values[self.index:self.index + available])
+            self.index += available
+            n -= available
         
-        for i in range(RANDOM_BATCH_SIZE):
-            val = self.gen_values[i]
-            self.gen_values[i] = max(val, self.mean - 3 * self._std_div, 5)
+        return np.concatenate(parts) if parts else np.empty(0)
+
+
+class NormalDist(BatchedDist):
+    __slots__ = '_std_div'
+    def __init__(self, mean: float, std_div: float, random_gen: np.random.Generator):
+        super().__init__(mean, random_gen)
+        self._std_div = std_div
+    
+    def draw(self, size: int) -> np.ndarray:
+        values = self._random_gen.normal(self.mean, self._std_div, size=size)
+        return np.maximum(values, max(self.mean - 3 * self._std_div, 5))
     
     def __str__(self):
         return f'Normal with mean {self.mean} and sigma {self._std_div}'
 
 
-class UniformDist():
-    __slots__ = '_low', '_high', '_random_gen', 'mean', 'index', 'gen_values'
-    def __init__(self, low: float, high: float):
+class UniformDist(BatchedDist):
+    __slots__ = '_low', '_high'
+    def __init__(self, low: float, high: float, random_gen: np.random.Generator):
+        super().__init__((low + high * 1.0) / 2, random_gen)
         self._low = low
         self._high = high
-        self._random_gen = np.random.default_rng()
         
-        self.mean = (low + high * 1.0) / 2
-        self.refill_values()
-        
-    def refill_values(self):
-        self.index = 0
-        self.gen_values = self._random_gen.uniform(self._low, self._high, size=RANDOM_BATCH_SIZE)
+    def draw(self, size: int) -> np.ndarray:
+        return self._random_gen.uniform(self._low, self._high, size=size)
         
     def __str__(self):
         return f'Uniform between {self._low} and {self._high}'
 
 
-class MultiplePeaksDist():
-    __slots__ = '_values', '_probs', 'mean', 'index', 'gen_values'
-    def __init__(self, values : List[float], probs : List[float]):
+class MultiplePeaksDist(BatchedDist):
+    __slots__ = '_values', '_probs', '_sampler'
+    def __init__(self, values : List[float], probs : List[float], random_gen: np.random.Generator):
         if not len(probs) == len(values):
             raise ValueError(f'length mismatch for probs: {probs} and values {values} {len(probs)} != {len(values)}')
         
         if not fsum(probs) == 1:
             raise ValueError(f'Invalid Probabilities - the sum is: {fsum(probs)}')
         
+        super().__init__(reduce(lambda acc, curr: acc + curr[0] * curr[1], zip(values, probs), 0), random_gen)
         self._values = values
         self._probs = probs
-        
-        self.mean = reduce(lambda acc, curr: acc + curr[0] * curr[1], zip(self._values, self._probs), 0)
-        self.refill_values()
+        self._sampler = AliasSampler(probs)
     
-    def refill_values(self):
-        self.index = 0
-        self.gen_values = np.random.choice(self._values, p=self._probs, size=RANDOM_BATCH_SIZE)
+    def draw(self, size: int) -> np.ndarray:
+        return np.asarray(self._values, dtype=np.float64)[self._sampler.sample(size, self._random_gen)]
         
     def __str__(self):
         return f'{len(self._values)} Peaks with values {self._values} and probabilty {self._probs}'
 
+
+@lru_cache(maxsize=None)
+def loadInverseCDF(path: str) -> np.ndarray:
+    """
+    Loads the measured latencies of a dns-timing result - a time_rank_*.csv file or a parquet file or partition directory -
+    as a sorted array, which is the inverse CDF of their empirical distribution. Failed measurements (NaN) are dropped.
+    Each file is only read once, the table is shared by every EmpiricalDist of the same file.
+    """
+    if path.endswith('.csv'):
+        with open(path) as f:
+            latencies = np.array([float(row['latency']) if row['latency'] else np.nan for row in DictReader(f)])
+    else:
+        import pyarrow.parquet as pq
+        latencies = pq.read_table(path, columns=['latency']).column('latency').to_numpy(zero_copy_only=False).astype(np.float64)
+    
+    table = np.sort(latencies[~np.isnan(latencies)])
+    if len(table) == 0:
+        raise ValueError(f'No latency measurements in {path}')
+    table.flags.writeable = False
+    return table
+
+
+class EmpiricalDist(BatchedDist):
+    """
+    Samples the measured latencies of a dns-timing result through their inverse CDF table,
+    a batch costs a single uniform draw and a single gather, regardless of the number of distinct values.
+    """
+    __slots__ = '_path', '_table'
+    def __init__(self, path: str, random_gen: np.random.Generator):
+        self._path = path
+        self._table = loadInverseCDF(path)
+        super().__init__(float(self._table.mean()), random_gen)
+    
+    def draw(self, size: int) -> np.ndarray:
+        return self._table[(self._random_gen.random(size) * len(self._table)).astype(np.int64)]
+    
+    def __str__(self):
+        return f'Empirical with {len(self._table)} measurements from {self._path}'
+
      
-class SingleValueDist():
-    __slots__ = 'mean', 'index', 'gen_values'
-    def __init__(self, val: float):
-        self.mean = val
-        self.gen_values = [val] * RANDOM_BATCH_SIZE
+class SingleValueDist(BatchedDist):
+    """
+    A constant needs no batch at all.
+    """
+    __slots__ = ()
+    def draw(self, size: int) -> np.ndarray:
+        return np.full(size, self.mean, dtype=np.float64)
+    
+    def take(self, n: int) -> np.ndarray:
+        return self.draw(n)
+    
+    def __str__(self):
+        return f'Single Value of {self.mean}'
+
+
+Compression = namedtuple('Compression', ['codec', 'level', 'threads'])
+
+COMPRESSION_SUFFIXES = {'xz': 'xz', 'zstd': 'zst'}
+DEFAULT_COMPRESSION_LEVELS = {'xz': 6, 'zstd': 3}
+
+
+class CompressedOutput():
+    """
+    A binary output stream that is compressed on the fly by a multithreaded xz or zstd process,
+    so the uncompressed trace is never written to the disk.
+    """
+    def __init__(self, output_path: str, compression: Compression):
+        level = compression.level if compression.level is not None else DEFAULT_COMPRESSION_LEVELS[compression.codec]
         
-        self.refill_values()
+        if which(compression.codec) is None:
+            raise ValueError(f'{compression.codec} was not found, it is required for compressing the traces')
         
+        self._outputFile = open(output_path, 'wb')
+        self._process = Popen([compression.codec, f'-T{compression.threads}', f'-{level}', '-q', '-c'], 
+                              stdin=PIPE, stdout=self._outputFile)
+    
+    def write(self, data: bytes):
+        self._process.stdin.write(data)
+    
+    def close(self):
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        self._outputFile.close()
         
-    def refill_values(self):
-        self.index = 0
+        if returncode != 0:
+            raise RuntimeError(f'Compression failed with exit code {returncode}')
+
+
+def openTraceOutput(output_file_name: str, extension: str, compression: Compression = None):
+    if compression is None:
+        return open(f'{output_file_name}.{extension}', 'wb')
     
-    def __str__(self):
-        return f'Single Value of {self.mean}'
+    return CompressedOutput(f'{output_file_name}.{extension}.{COMPRESSION_SUFFIXES[compression.codec]}', compression)
 
 
-def compressTrace(output_file_name: str, should_remove=False):
-    with Timer(msg='compression') as t:
-        with tarfile.open(f'{output_file_name}.xz', mode="w:xz") as tar:
-            tar.add(f'{output_file_name}.trace')
-            
-    if should_remove:
-        run(['rm', f'{output_file_name}.trace'])
+def readBinaryTrace(path: str) -> np.memmap:
+    """
+    Memory maps a binary trace, the fields of the requests are accessible as columns, e.g. trace['delay'].
+    """
+    return np.memmap(path, dtype=TRACE_RECORD_DTYPE, mode='r')
+
+
+def readKeys(path: str) -> np.memmap:
+    """
+    Memory maps a raw little endian uint64 key file.
+    """
+    return np.memmap(path, dtype='<u8', mode='r')
 
       
-class KeyInfo():
-    def __init__(self, dist_generator):
-        self.dist_gen = dist_generator
-        self.occurences = 1
+class KeyStore():
+    """
+    The state of every key seen so far: the keys are kept sorted in a single uint64 array,
+    with parallel cluster ids (uint8 for up to 256 clusters) and uint32 occurence counts - 13 bytes per key
+    instead of a dict entry and an object.
+    """
+    __slots__ = 'keys', 'clusters', 'occurences'
+    def __init__(self, num_of_clusters: int = 256):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.clusters = np.empty(0, dtype=np.min_scalar_type(max(num_of_clusters - 1, 0)))
+        self.occurences = np.empty(0, dtype=np.uint32)
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def lookup(self, keys: np.ndarray):
+        """
+        Returns the positions of the given keys in the store and a mask of the keys that are found there.
+        """
+        positions = np.searchsorted(self.keys, keys)
+        found = np.zeros(len(keys), dtype=bool)
+        in_range = positions < len(self.keys)
+        found[in_range] = self.keys[positions[in_range]] == keys[in_range]
+        return positions, found
+    
+    @staticmethod
+    def concatenate(key_stores: List['KeyStore']) -> 'KeyStore':
+        """
+        Merges the stores of disjoint sets of keys, e.g. of different hash partitions.
+        """
+        merged = KeyStore()
+        keys = np.concatenate([merged.keys] + [key_store.keys for key_store in key_stores])
+        order = np.argsort(keys, kind='stable')
+        merged.keys = keys[order]
+        merged.clusters = np.concatenate([merged.clusters] + [key_store.clusters for key_store in key_stores])[order]
+        merged.occurences = np.concatenate([merged.occurences] + [key_store.occurences for key_store in key_stores])[order]
+        return merged
+    
+    def insert(self, keys: np.ndarray, clusters: np.ndarray, occurences: np.ndarray):
+        """
+        Inserts new sorted unique keys, keeping the store sorted.
+        """
+        positions = np.searchsorted(self.keys, keys)
+        self.keys = np.insert(self.keys, positions, keys)
+        self.clusters = np.insert(self.clusters, positions, clusters)
+        self.occurences = np.insert(self.occurences, positions, occurences)
 
 
-def writeMetaData(fname: str, time_generators: List, cluster_dists: List[float], latency_values: np.array, keysTimeDistDict: Dict[str, KeyInfo]):
+def writeMetaData(fname: str, time_generators: List, cluster_dists: List[float], latencies_histogram: np.array, key_store: KeyStore):
     cluster_data = [{'probability': cluster_dists[i], 'dist info': str(time_generators[i])} for i in range(len(time_generators))]
     
-    latencies_histogram, latencies_bins = np.histogram(latency_values, bins=[0, 10, 100, 1000, 10000, inf])
-    latencies_data = [{'histogram': latencies_histogram.tolist(), 'bins': latencies_bins.tolist()}]
+    latencies_data = [{'histogram': latencies_histogram.tolist(), 'bins': LATENCY_BINS}]
     
-    occurences_aggregate = [key_info.occurences for key_info in keysTimeDistDict.values()]
-    occurences_histogram, occurences_bins = np.histogram(occurences_aggregate, bins=[1, 2, 3, 4, 5, 10, 20, 30, 40, 50, 100, 1000, 10000, inf])
+    occurences_histogram, occurences_bins = np.histogram(key_store.occurences, bins=[1, 2, 3, 4, 5, 10, 20, 30, 40, 50, 100, 1000, 10000, inf])
     occurences_data = [{'histogram': occurences_histogram.tolist(), 'bins': occurences_bins.tolist()}]
     
     data = {'clusters data': cluster_data, 'latencies data': latencies_data, 'occurences data': occurences_data}
@@ -132,70 +335,408 @@ def writeMetaData(fname: str, time_generators: List, cluster_dists: List[float],
         dump(data, jsonFile, indent=4)
 
         
-def addDelayAndWriteToFile(fnames: List[str], time_generators: List, cluster_dists: List[float], 
-                           verbose: bool, compress: bool, hit_penalty=1, set_name: str = None):
-    latency_values = np.array([])
+def readChunks(fname: str, chunk_size: int = CHUNK_SIZE) -> Generator[np.ndarray, None, None]:
+    """
+    Reads the input file in chunks of at most chunk_size keys, so only a single chunk is held in memory at a time.
+    Binary key files are memory mapped and sliced instead of parsed.
+    """
+    if fname.endswith(f'.{KEYS_EXTENSION}'):
+        keys = readKeys(f'{INPUT_DIR}/{fname}')
+        for start in range(0, len(keys), chunk_size):
+            yield keys[start:start + chunk_size].astype(np.uint64)
+        return
+    
+    with open(f'{INPUT_DIR}/{fname}') as inputFile:
+        chunk = list(islice(inputFile, chunk_size))
+        while chunk:
+            yield np.fromiter(map(int, chunk), dtype=np.uint64, count=len(chunk))
+            chunk = list(islice(inputFile, chunk_size))
+
+
+def addDelaysToChunk(keys: np.ndarray, time_generators: List, cluster_sampler: AliasSampler, key_store: KeyStore,
+                     random_gen: np.random.Generator):
+    """
+    Assigns the delays of a whole chunk of keys at once.
+    The keys are factorized, the clusters of all the new keys are drawn with a single call,
+    and each generator hands out the delays of all of its requests in the chunk as one slice of its batch.
+    Returns the delays and means of the requests, in the order of the keys.
+    """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    occurences = np.bincount(inverse).astype(np.uint32)
+    
+    positions, found = key_store.lookup(unique_keys)
+    new_keys = ~found
+    
+    unique_clusters = np.empty(len(unique_keys), dtype=key_store.clusters.dtype)
+    unique_clusters[found] = key_store.clusters[positions[found]]
+    unique_clusters[new_keys] = cluster_sampler.sample(np.count_nonzero(new_keys), random_gen)
+    
+    key_store.occurences[positions[found]] += occurences[found]
+    key_store.insert(unique_keys[new_keys], unique_clusters[new_keys], occurences[new_keys])
+    
+    clusters = unique_clusters[inverse]
     
-    keysTimeDistDict : Dict[str, KeyInfo] = dict()
+    delays = np.empty(len(keys))
+    means = np.empty(len(keys))
+    for cluster, dist_gen in enumerate(time_generators):
+        positions = np.flatnonzero(clusters == cluster)
+        delays[positions] = dist_gen.take(len(positions))
+        means[positions] = dist_gen.mean
     
+    return delays, means
+
+
+def outputFileName(fnames: List[str], set_name: str = None) -> str:
     current_time = datetime.datetime.now()
     
     if set_name is not None:
-        output_file_name = f'{OUTPUT_DIR}/{set_name}'
-    else:
-        if len(fnames) > 1:
-            output_file_name = f'{OUTPUT_DIR}/latency_{current_time.strftime("%H%M%S_%d%m%Y")}'
+        return f'{OUTPUT_DIR}/{set_name}'
+    
+    if len(fnames) > 1:
+        return f'{OUTPUT_DIR}/latency_{current_time.strftime("%H%M%S_%d%m%Y")}'
+    
+    return f'{OUTPUT_DIR}/{fnames[0]}_{current_time.strftime("%H%M%S_%d%m%Y")}'
+
+
+class LatencyTraceWriter():
+    """
+    Generates the timed trace of a single configuration, chunk by chunk.
+    The latencies are only kept as a histogram, so the memory usage does not grow with the length of the trace
+    (apart from the per key information).
+    """
+    def __init__(self, output_file_name: str, time_generators: List, cluster_dists: List[float], random_gen: np.random.Generator,
+                 hit_penalty=1, binary=False, compression: Compression = None):
+        self.output_file_name = output_file_name
+        self.binary = binary
+        self.extension = BINARY_TRACE_EXTENSION if binary else 'trace'
+        self.time_generators = time_generators
+        self.cluster_dists = cluster_dists
+        self.cluster_sampler = AliasSampler(cluster_dists)
+        self._random_gen = random_gen
+        self.hit_penalty = hit_penalty
+        
+        self.latencies_histogram = np.zeros(len(LATENCY_BINS) - 1, dtype=np.int64)
+        self.key_store = KeyStore(len(cluster_dists))
+        self.outputFile = openTraceOutput(output_file_name, self.extension, compression)
+    
+    def add_chunk(self, keys: np.ndarray):
+        delays, means = addDelaysToChunk(keys, self.time_generators, self.cluster_sampler, self.key_store, self._random_gen)
+        self.write_chunk(keys, delays, means)
+    
+    def write_chunk(self, keys: np.ndarray, delays: np.ndarray, means: np.ndarray):
+        if self.binary:
+            records = np.empty(len(keys), dtype=TRACE_RECORD_DTYPE)
+            records['key'] = keys
+            records['hit_penalty'] = self.hit_penalty
+            records['delay'] = delays
+            records['mean'] = means
+            self.outputFile.write(records.tobytes())
         else:
-            output_file_name = f'{OUTPUT_DIR}/{fnames[0]}_{current_time.strftime("%H%M%S_%d%m%Y")}'
+            self.outputFile.write(''.join([f'{key} {self.hit_penalty} {delay} {mean}\n' 
+                                           for key, delay, mean in zip(keys.tolist(), delays.tolist(), means.tolist())]).encode())
+        
+        self.latencies_histogram += np.histogram(delays, bins=LATENCY_BINS)[0]
     
-    with open(f'{output_file_name}.trace', 'w') as outputFile:
-        for fname, _ in zip(fnames, tqdm.tqdm(range(len(fnames)), colour='yellow', leave=False)):
-            with open(f'{INPUT_DIR}/{fname}') as inputFile:
-                lines = inputFile.readlines()
-                num_of_lines = len(lines)
-                
-                current_file_latencies = np.zeros(num_of_lines)                
-                
-                for idx in tqdm.trange(num_of_lines, colour='cyan', leave=False):
-                    line = lines[idx]
-                    key = line.strip('\n ')
-                    
-                    current_key_info : KeyInfo = keysTimeDistDict.get(key)
-                    
-                    if not current_key_info is None:
-                        dist_gen = current_key_info.dist_gen
-                        current_key_info.occurences += 1
-                    else:
-                        chosen_cluster = np.random.choice(range(len(time_generators)), p=cluster_dists)
-                        dist_gen = time_generators[chosen_cluster]
-                        keysTimeDistDict[key] = KeyInfo(dist_gen)
-                    
-                    """
-                    Here, using the fields instead of functions in order to reduce the call time.
-                    Moreover, the usage of batches lowers the computation time by 90%!
-                    """
-                    delay, mean = dist_gen.gen_values[dist_gen.index], dist_gen.mean
-                    dist_gen.index += 1
-                    
-                    if dist_gen.index >= RANDOM_BATCH_SIZE:
-                        dist_gen.refill_values()
-                    
-                    current_file_latencies[idx] = delay
-                    
-                    outputFile.write(f'{key} {hit_penalty} {delay} {mean}\n')
+    def close(self, verbose: bool = False):
+        self.outputFile.close()
+        
+        if (verbose):
+            print(f'{Colors.orange}Wrote {Colors.cyan}{self.output_file_name}{Colors.orange} with {Colors.cyan}{len(self.key_store):,}'
+                  + f'{Colors.orange} unique entries{Colors.reset}')
+        
+        writeMetaData(self.output_file_name, self.time_generators, self.cluster_dists, self.latencies_histogram, self.key_store)
+
+
+def readAllChunks(fnames: List[str], verbose: bool) -> Generator[np.ndarray, None, None]:
+    for fname, _ in zip(fnames, tqdm.tqdm(range(len(fnames)), colour='yellow', leave=False)):
+        num_of_lines = 0
+        
+        with tqdm.tqdm(unit=' lines', colour='cyan', leave=False) as progress:
+            for keys in readChunks(fname):
+                yield keys
                 
-                if (verbose):
-                    print(f'{Colors.orange}Added latencies to {Colors.cyan}{len(lines):,} '
-                        + f'{Colors.orange} lines with {Colors.cyan}{len(keysTimeDistDict):,}'
-                        + f'{Colors.orange} unique entries so far{Colors.reset}')
+                num_of_lines += len(keys)
+                progress.update(len(keys))
+        
+        if (verbose):
+            print(f'{Colors.orange}Added latencies to {Colors.cyan}{num_of_lines:,}{Colors.orange} lines of {Colors.cyan}{fname}{Colors.reset}')
+
+
+def _checkWorkers(workers: List[Process]):
+    for worker in workers:
+        if not worker.is_alive() and worker.exitcode != 0:
+            raise RuntimeError(f'Trace generation worker failed with exit code {worker.exitcode}')
+
+
+def _putChecked(queue: Queue, item, workers: List[Process]):
+    """
+    Puts an item on a worker's queue, failing instead of blocking forever if a worker dies and stops draining its queue.
+    """
+    while True:
+        try:
+            queue.put(item, timeout=WORKER_POLL_INTERVAL)
+            return
+        except Full:
+            _checkWorkers(workers)
+
+
+def _getChecked(queue: Queue, workers: List[Process]):
+    while True:
+        try:
+            return queue.get(timeout=WORKER_POLL_INTERVAL)
+        except Empty:
+            _checkWorkers(workers)
+
+
+def _joinWorkers(workers: List[Process]):
+    for worker in workers:
+        worker.join()
+    _checkWorkers(workers)
+
+
+def _terminateWorkers(workers: List[Process], queues: List[Queue]):
+    """
+    Stops all the workers after a failure. The chunks still buffered for them are dropped,
+    otherwise this process would block on exit trying to flush them into the pipes of dead workers.
+    """
+    for queue in queues:
+        queue.cancel_join_thread()
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+    for worker in workers:
+        worker.join()
+
+
+def _fanOutWorker(chunks_queue: Queue, output_file_names: List[str], time_generators: List, cluster_dists: List, random_gen: np.random.Generator,
+                  verbose: bool, compression: Compression, hit_penalty, binary: bool):
+    # the distributions arrive with a copy of the run's generator, the worker's own stream replaces it
+    for dist_gen in [dist_gen for configuration in time_generators for dist_gen in configuration]:
+        dist_gen.use(random_gen)
+    writers = [LatencyTraceWriter(output_file_names[i], time_generators[i], cluster_dists[i], random_gen, hit_penalty, binary, compression) 
+               for i in range(len(output_file_names))]
+    
+    keys = chunks_queue.get()
+    while keys is not None:
+        for writer in writers:
+            writer.add_chunk(keys)
+        keys = chunks_queue.get()
+    
+    for writer in writers:
+        writer.close(verbose)
+
+
+def addDelayAndWriteToFiles(fnames: List[str], time_generators: List, cluster_dists: List, sets_names: List[str], random_gen: np.random.Generator,
+                            verbose: bool, compression: Compression = None, hit_penalty=1, jobs: int = 0, binary=False):
+    """
+    Generates the traces of all the configurations from a single pass over the input files.
+    Each chunk of keys is read once and handed to the writer of every configuration.
+    With jobs > 0 the configurations are split between that many worker processes, each with its own output streams
+    and its own generator spawned from random_gen.
+    """
+    output_file_names = [outputFileName(fnames, set_name) for set_name in sets_names]
+    
+    if jobs <= 0:
+        writers = [LatencyTraceWriter(output_file_names[i], time_generators[i], cluster_dists[i], random_gen, hit_penalty, binary, compression) 
+                   for i in range(len(output_file_names))]
+        
+        for keys in readAllChunks(fnames, verbose):
+            for writer in writers:
+                writer.add_chunk(keys)
+        
+        for writer in writers:
+            writer.close(verbose)
+        return
+    
+    workers = []
+    jobs = min(jobs, len(output_file_names))
+    for job, worker_gen in enumerate(random_gen.spawn(jobs)):
+        chunks_queue = Queue(maxsize=FAN_OUT_QUEUE_SIZE)
+        worker = Process(target=_fanOutWorker, args=(chunks_queue, output_file_names[job::jobs], time_generators[job::jobs], 
+                                                     cluster_dists[job::jobs], worker_gen, verbose, compression, hit_penalty, binary))
+        worker.start()
+        workers.append((worker, chunks_queue))
+    
+    processes = [worker for worker, _ in workers]
+    try:
+        for keys in readAllChunks(fnames, verbose):
+            for _, chunks_queue in workers:
+                _putChecked(chunks_queue, keys, processes)
+        
+        for _, chunks_queue in workers:
+            _putChecked(chunks_queue, None, processes)
+        
+        _joinWorkers(processes)
+    except BaseException:
+        _terminateWorkers(processes, [chunks_queue for _, chunks_queue in workers])
+        raise
 
-                latency_values = np.concatenate((latency_values, current_file_latencies))
+
+def hashPartitions(keys: np.ndarray) -> np.ndarray:
+    """
+    The hash partition of every key, a splitmix64 finalizer spreads the keys uniformly over the SEED_PARTITIONS partitions.
+    """
+    z = keys.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return ((z ^ (z >> np.uint64(31))) % np.uint64(SEED_PARTITIONS)).astype(np.int64)
+
+
+class SeededPartitions():
+    """
+    The generation state of one configuration for a subset of the hash partitions.
+    Every partition has its own copy of the distributions, its own key store and its own cluster generator,
+    all seeded from the partition's child of the configuration's SeedSequence, so the delays of a partition
+    only depend on the seed and on the partition's own requests - not on which process generates it.
+    """
+    def __init__(self, seed: np.random.SeedSequence, partitions: List[int], time_generators: List, cluster_dists: List[float]):
+        self.partitions = partitions
+        self.cluster_sampler = AliasSampler(cluster_dists)
+        self.random_gens, self.time_generators, self.key_stores = {}, {}, {}
+        
+        children = seed.spawn(SEED_PARTITIONS)
+        for partition in partitions:
+            cluster_seed, *dists_seeds = children[partition].spawn(1 + len(time_generators))
+            self.random_gens[partition] = np.random.default_rng(cluster_seed)
+            # the batches of a partition are capped, so all the partitions together hold about as much as a single distribution
+            self.time_generators[partition] = [dist_gen.spawn(dist_seed, MIN_BATCH_SIZE // SEED_PARTITIONS, RANDOM_BATCH_SIZE // SEED_PARTITIONS) 
+                                               for dist_gen, dist_seed in zip(time_generators, dists_seeds)]
+            self.key_stores[partition] = KeyStore(len(cluster_dists))
+    
+    def add_chunk(self, keys: np.ndarray, partitions: np.ndarray):
+        """
+        Returns the delays and means of requests of this subset of the partitions, given in the order of the trace.
+        """
+        delays = np.empty(len(keys))
+        means = np.empty(len(keys))
+        
+        order = np.argsort(partitions, kind='stable')
+        bounds = np.searchsorted(partitions[order], np.arange(SEED_PARTITIONS + 1))
+        for partition in self.partitions:
+            positions = order[bounds[partition]:bounds[partition + 1]]
+            if len(positions):
+                delays[positions], means[positions] = addDelaysToChunk(keys[positions], self.time_generators[partition], self.cluster_sampler, 
+                                                                       self.key_stores[partition], self.random_gens[partition])
+        
+        return delays, means
+    
+    def key_store(self) -> KeyStore:
+        return KeyStore.concatenate(list(self.key_stores.values()))
+
+
+def configurationSeeds(seed: int, configurations: int) -> List[np.random.SeedSequence]:
+    return np.random.SeedSequence(seed).spawn(configurations)
+
+
+def _seededWorker(requests_queue: Queue, results_queue: Queue, seed: int, partitions: List[int], time_generators: List, cluster_dists: List):
+    configurations = [SeededPartitions(config_seed, partitions, time_generators[i], cluster_dists[i]) 
+                      for i, config_seed in enumerate(configurationSeeds(seed, len(time_generators)))]
+    
+    requests = requests_queue.get()
+    while requests is not None:
+        results_queue.put([configuration.add_chunk(*requests) for configuration in configurations])
+        requests = requests_queue.get()
+    
+    results_queue.put([configuration.key_store() for configuration in configurations])
+
+
+def addSeededDelayAndWriteToFiles(fnames: List[str], time_generators: List, cluster_dists: List, sets_names: List[str], random_gen: np.random.Generator, seed: int,
+                                  verbose: bool, compression: Compression = None, hit_penalty=1, jobs: int = 0, binary=False):
+    """
+    Generates reproducible traces of all the configurations from a single pass over the input files.
+    The key space is split into SEED_PARTITIONS hash partitions, each with its own SeedSequence stream,
+    and with jobs > 1 the partitions are split between that many worker processes.
+    Each chunk is written once all the workers have returned its delays, so the traces are bit-identical for a given seed
+    regardless of the number of workers.
+    """
+    writers = [LatencyTraceWriter(outputFileName(fnames, set_name), time_generators[i], cluster_dists[i], random_gen, hit_penalty, binary, compression) 
+               for i, set_name in enumerate(sets_names)]
+    
+    if jobs <= 1:
+        configurations = [SeededPartitions(config_seed, list(range(SEED_PARTITIONS)), time_generators[i], cluster_dists[i]) 
+                          for i, config_seed in enumerate(configurationSeeds(seed, len(time_generators)))]
+        
+        for keys in readAllChunks(fnames, verbose):
+            partitions = hashPartitions(keys)
+            for writer, configuration in zip(writers, configurations):
+                writer.write_chunk(keys, *configuration.add_chunk(keys, partitions))
+        
+        for writer, configuration in zip(writers, configurations):
+            writer.key_store = configuration.key_store()
+            writer.close(verbose)
+        return
+    
+    jobs = min(jobs, SEED_PARTITIONS)
+    workers = []
+    for job in range(jobs):
+        requests_queue, results_queue = Queue(maxsize=FAN_OUT_QUEUE_SIZE), Queue()
+        worker = Process(target=_seededWorker, args=(requests_queue, results_queue, seed, list(range(job, SEED_PARTITIONS, jobs)), 
+                                                     time_generators, cluster_dists))
+        worker.start()
+        workers.append((worker, requests_queue, results_queue))
     
-    writeMetaData(output_file_name, time_generators, cluster_dists, latency_values, keysTimeDistDict)
+    processes = [worker for worker, _, _ in workers]
     
-    if (compress):
-        compressTrace(output_file_name)
+    def writeOldest(pending: deque):
+        keys, owners = pending.popleft()
+        results = [_getChecked(results_queue, processes) for _, _, results_queue in workers]
+        for i, writer in enumerate(writers):
+            delays = np.empty(len(keys))
+            means = np.empty(len(keys))
+            for job, worker_results in enumerate(results):
+                delays[owners[job]], means[owners[job]] = worker_results[i]
+            writer.write_chunk(keys, delays, means)
+    
+    try:
+        pending = deque()
+        for keys in readAllChunks(fnames, verbose):
+            partitions = hashPartitions(keys)
+            owners = [np.flatnonzero(partitions % jobs == job) for job in range(jobs)]
+            for job, (_, requests_queue, _) in enumerate(workers):
+                _putChecked(requests_queue, (keys[owners[job]], partitions[owners[job]]), processes)
+            pending.append((keys, owners))
+            if len(pending) > FAN_OUT_QUEUE_SIZE:
+                writeOldest(pending)
+        
+        while pending:
+            writeOldest(pending)
         
+        for _, requests_queue, _ in workers:
+            _putChecked(requests_queue, None, processes)
+        
+        key_stores = [_getChecked(results_queue, processes) for _, _, results_queue in workers]
+        _joinWorkers(processes)
+    except BaseException:
+        _terminateWorkers(processes, [queue for _, requests_queue, results_queue in workers for queue in (requests_queue, results_queue)])
+        raise
+    
+    for i, writer in enumerate(writers):
+        writer.key_store = KeyStore.concatenate([worker_key_stores[i] for worker_key_stores in key_stores])
+        writer.close(verbose)
+
+
+def empiricalSetName(path: str) -> str:
+    """
+    Names the trace of a dns-timing result after its origin, name server and ranks,
+    taken from the time_rank_* file name or from the values of the parquet partition directories
+    (followed by the file's stem when a single parquet file of a partition is given).
+    """
+    path = normpath(path)
+    partitions = [part.split('=', 1)[1] for part in path.split(sep) if '=' in part]
+    if not partitions:
+        return f'empirical_{splitext(basename(path))[0].replace("time_rank_", "")}'
+    
+    if '=' not in basename(path):
+        partitions.append(splitext(basename(path))[0])
+    return f'empirical_{"_".join(partitions)}'
+
+
+def verifySetsNames(sets_names: List[str]):
+    duplicates = sorted({name for name in sets_names if sets_names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Several configurations would write the same traces: {duplicates}')
+
+
 def verifyDists(cluster_dist: List[float], num_of_generators : int):
     dist_sum: float = fsum(cluster_dist)
     if dist_sum != 1.0 or num_of_generators != len(cluster_dist):
@@ -206,8 +747,15 @@ def verifyDists(cluster_dist: List[float], num_of_generators : int):
 def main():
     parser = argparse.ArgumentParser()
     
-    parser.add_argument('-c', '--compress', help="Compress the newly created traces files", action='store_true')
+    parser.add_argument('-c', '--compress', help="Compress the newly created traces files while they are generated", action='store_true')
+    parser.add_argument('--codec', help='The compression codec', choices=['xz', 'zstd'], default='xz')
+    parser.add_argument('--level', help='The compression level, the default level of the codec is used if not given', type=int)
+    parser.add_argument('--threads', help='Number of compression threads per trace, 0 uses all the cores', default=0, type=int)
     parser.add_argument('-v', '--verbose', help='Prints the time elapsed and number of unique entries for each file, in addition to the progress bar', action='store_true')
+    parser.add_argument('-b', '--binary', help='Write the traces as fixed width binary records instead of text lines', action='store_true')
+    parser.add_argument('-e', '--empirical', help='dns-timing results (time_rank_*.csv or parquet) to sample the latencies from, each one generates a trace with a single cluster instead of the configurations below', nargs='+')
+    parser.add_argument('-j', '--jobs', help='Number of worker processes the configurations (or with --seed the key partitions) are split between, 0 generates all of them in the main process', default=0, type=int)
+    parser.add_argument('-s', '--seed', help='Generate reproducible traces from this master seed, the traces are identical for any number of jobs', type=int)
     
     args = parser.parse_args()
     
@@ -237,24 +785,38 @@ def main():
     #               'alexa_opendns_100k_101k', 'alexa_opendns_100k_101k',
     #               'umbrella_googledns_100k_101k', 'umbrella_opendns_100k_101k']
     
-    time_generators = [[MultiplePeaksDist([50, 150], [0.9, 0.1]), MultiplePeaksDist([50, 150 * factor], [0.9, 0.1])] 
+    # a single generator is shared by every distribution of the run, with --seed the partitions spawn their own streams from the seed instead
+    random_gen = np.random.default_rng(args.seed)
+    
+    time_generators = [[MultiplePeaksDist([50, 150], [0.9, 0.1], random_gen), MultiplePeaksDist([50, 150 * factor], [0.9, 0.1], random_gen)] 
                        for factor in np.arange(10, 20.1, 1)]
     cluster_dists = [[0.5, 0.5] for factor in np.arange(10, 20.1, 1)]
     sets_names = [f'diff_factor_{factor}' for factor in np.arange(10, 20.1, 1)]
     
+    if args.empirical:
+        time_generators = [[EmpiricalDist(results, random_gen)] for results in args.empirical]
+        cluster_dists = [[1] for results in args.empirical]
+        sets_names = [empiricalSetName(results) for results in args.empirical]
+    
     if (not (len(time_generators) == len(cluster_dists))) or (not (sets_names is not None and len(time_generators) == len(sets_names))):
         raise ValueError(f'Number of cluster dist configurations: {len(cluster_dists)} and number of time generators configurations: {len(time_generators)}, or number of sets names mismatch')
     
     for i in range(len(cluster_dists)):
         verifyDists(cluster_dists[i], len(time_generators[i]))
+    verifySetsNames(sets_names)
         
-    input_files_paths = [f for f in listdir(INPUT_DIR)]
+    input_files_paths = sorted(listdir(INPUT_DIR))
+    compression = Compression(args.codec, args.level, args.threads) if args.compress else None
     
     makedirs(OUTPUT_DIR, exist_ok=True)
     
     with Timer():
-        for i in tqdm.trange(len(time_generators), colour='magenta', leave=False):
-            addDelayAndWriteToFile(input_files_paths, time_generators[i], cluster_dists[i], verbose=args.verbose, compress=args.compress, set_name=sets_names[i])
+        if args.seed is not None:
+            addSeededDelayAndWriteToFiles(input_files_paths, time_generators, cluster_dists, sets_names, random_gen, args.seed,
+                                          verbose=args.verbose, compression=compression, jobs=args.jobs, binary=args.binary)
+        else:
+            addDelayAndWriteToFiles(input_files_paths, time_generators, cluster_dists, sets_names, random_gen,
+                                    verbose=args.verbose, compression=compression, jobs=args.jobs, binary=args.binary)
             
 if __name__ == '__main__':
     main()
@@ -0,0 +1,41 @@
+import numpy as np
+
+from typing import List
+
+
+class AliasSampler():
+    """
+    Draws indices from a discrete distribution in O(1) per draw with Vose's alias method:
+    the table is built once, and every draw is a uniform column plus a biased coin flip between the column and its alias.
+    """
+    __slots__ = 'probs', '_accept', '_alias'
+    def __init__(self, probs: List[float]):
+        probs = np.asarray(probs, dtype=np.float64)
+        if len(probs) == 0 or (probs < 0).any() or probs.sum() <= 0:
+            raise ValueError(f'Invalid Probabilities: {probs.tolist()}')
+
+        self.probs = probs / probs.sum()
+        n = len(self.probs)
+        scaled = (self.probs * n).tolist()
+        accept = [1.0] * n
+        alias = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            accept[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # whatever is left is 1 up to rounding errors, and always accepts its own column
+
+        self._accept = np.array(accept)
+        self._alias = np.array(alias, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.probs)
+
+    def sample(self, size: int, random_gen: np.random.Generator) -> np.ndarray:
+        columns = random_gen.integers(len(self.probs), size=size)
+        return np.where(random_gen.random(size) < self._accept[columns], columns, self._alias[columns])
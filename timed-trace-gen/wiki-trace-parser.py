@@ -1,5 +1,14 @@
+import argparse
+import bz2
+import gzip
+import json
+import lzma
+import re
 import mmh3
 
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
 from os.path import *
 from os import path, listdir, makedirs
 
@@ -16,52 +25,175 @@ IGNORED_PREFIXES = ["wiki/Special:Search", "w/query.php","wiki/Talk:", "wiki/Spe
 OUTPUT_DIR = './processed'
 OUTPUT_FILE_PREFIX = f'{OUTPUT_DIR}/processed_'
 
+CHUNK_SIZE = 64 << 20
+
+# The magic bytes and openers of the compressed input formats
+COMPRESSED_FORMATS = {b'\x1f\x8b' : ('gz', gzip.open), b'\xfd7zXZ\x00' : ('xz', lzma.open), b'BZh' : ('bz2', bz2.open)}
+KEYS_EXTENSION = 'keys'
+
+
+def compileFilter(prefixes: List[str], tags: List[str]):
+    """
+    Compiles the ignored prefixes and url tags into a single bytes regex,
+    so each url is scanned once instead of once per prefix and tag.
+    """
+    alternatives = []
+    if prefixes:
+        alternatives.append(b'\\A(?:' + b'|'.join(re.escape(prefix.encode()) for prefix in prefixes) + b')')
+    alternatives.extend(re.escape(tag.encode()) for tag in tags)
+    return re.compile(b'|'.join(alternatives) if alternatives else b'(?!)')
+
+
+def loadFilter(rules_file: str = None):
+    """
+    Loads the filter from a JSON rules file with "ignored_prefixes" and "ignored_url_tags" lists,
+    a missing list (or a missing file) falls back to the defaults above.
+    """
+    rules = {}
+    if rules_file is not None:
+        with open(rules_file) as f:
+            rules = json.load(f)
+    return compileFilter(rules.get('ignored_prefixes', IGNORED_PREFIXES), rules.get('ignored_url_tags', IGNORED_URL_TAGS))
 
-def parseLine(entry: str):   
-    url = entry.split(' ')[2]
+
+IGNORED_URLS = loadFilter()
+
+
+def parseLine(entry: bytes, ignored_urls = IGNORED_URLS):
+    url = entry.split(b' ')[2]
     
-    for prefix in IGNORED_PREFIXES:
-        if url.startswith(prefix):
-            return None
-        for tag in IGNORED_URL_TAGS:
-            if tag in url:
-                return None
+    if ignored_urls.search(url):
+        return None
     
     return url
 
 
-def _processFile(fname: str):
-    with open(f'./input/{fname}', encoding='utf-8',errors='replace') as wiki:
-        with open(f'{OUTPUT_FILE_PREFIX}{fname}','w') as outputFile:
-            line = wiki.readline()
-            count = 1
-            while line:
-                url = parseLine(line)
-                if url != None:
-                    key = str(int.from_bytes(mmh3.hash_bytes(url)[-8:],'big'))
-                    outputFile.write('%s\n'%key)
-                line = wiki.readline()
-                count += 1
+def _processLines(data: bytes, ignored_urls, binary: bool = False) -> bytes:
+    """
+    Hashes the urls that pass the filter, as decimal lines or as raw little endian uint64 keys if binary.
+    """
+    hashes = [mmh3.hash_bytes(url)[-8:] for url in (parseLine(line, ignored_urls) for line in data.splitlines()) if url != None]
+    if binary:
+        return b''.join(key[::-1] for key in hashes)
+    return ''.join('%s\n'%int.from_bytes(key,'big') for key in hashes).encode()
+
+
+def _processChunk(task) -> bytes:
+    """
+    Filters and hashes one chunk of a wiki file, given either as its (path, start, end) byte range or as the lines themselves.
+    """
+    chunk, ignored_urls, binary = task
+    if isinstance(chunk, bytes):
+        return _processLines(chunk, ignored_urls, binary)
+    
+    fname, start, end = chunk
+    with open(fname, 'rb') as wiki:
+        wiki.seek(start)
+        return _processLines(wiki.read(end - start), ignored_urls, binary)
+
+
+def fileRanges(fname: str, chunk_size: int = CHUNK_SIZE) -> Generator:
+    """
+    Splits an uncompressed file into byte ranges of about chunk_size that end on a line boundary.
+    """
+    size = path.getsize(fname)
+    with open(fname, 'rb') as wiki:
+        start = 0
+        while start < size:
+            wiki.seek(min(start + chunk_size, size))
+            wiki.readline()
+            end = wiki.tell()
+            yield fname, start, end
+            start = end
+
+
+def streamBlocks(stream, chunk_size: int = CHUNK_SIZE) -> Generator[bytes, None, None]:
+    """
+    Reads a stream in blocks of about chunk_size that end on a line boundary, used for compressed files that cannot be seeked.
+    """
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            return
+        yield block + stream.readline()
+
+
+def compressionFormat(fname: str):
+    """
+    Returns the (suffix, opener) of a compressed file by its magic bytes, or None if it is not compressed.
+    """
+    with open(fname, 'rb') as wiki:
+        magic = wiki.read(6)
+    for prefix, compression in COMPRESSED_FORMATS.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
 
 
-def processFiles(files : List[str]):
+def outputFileName(fname: str, binary: bool = False) -> str:
+    for suffix, _ in COMPRESSED_FORMATS.values():
+        if fname.endswith(f'.{suffix}'):
+            fname = fname[:-len(suffix) - 1]
+            break
+    return f'{OUTPUT_FILE_PREFIX}{fname}.{KEYS_EXTENSION}' if binary else f'{OUTPUT_FILE_PREFIX}{fname}'
+
+
+def _processFile(fname: str, ignored_urls = IGNORED_URLS, pool: Pool = None, jobs: int = 1, binary: bool = False):
+    """
+    Uncompressed files are split into byte ranges that the workers read themselves,
+    gz/xz/bz2 files are decompressed by this process and handed to the workers block by block.
+    The chunks are written in order, with at most 2 * jobs of them in flight.
+    """
+    input_file = f'./input/{fname}'
+    compression = compressionFormat(input_file)
+    
+    with open(outputFileName(fname, binary),'wb') as outputFile:
+        with (compression[1](input_file, 'rb') if compression else open(input_file, 'rb')) as wiki:
+            chunks = streamBlocks(wiki) if compression else fileRanges(input_file)
+            if pool is None:
+                for chunk in chunks:
+                    outputFile.write(_processChunk((chunk, ignored_urls, binary)))
+                return
+            
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_processChunk, ((chunk, ignored_urls, binary),)))
+                if len(pending) > 2 * jobs:
+                    outputFile.write(pending.popleft().get())
+            while pending:
+                outputFile.write(pending.popleft().get())
+
+
+def processFiles(files : List[str], ignored_urls = IGNORED_URLS, jobs: int = 1, binary: bool = False):
     print(f'processing the files: {files}\n')
-    for file in files:
-        if not path.exists(f'{OUTPUT_FILE_PREFIX}{file}'):
-            print(f'start processing {file}')
-            with Timer():
-                _processFile(file)
-                
-            print(f'done processing: {file}')
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        for file in files:
+            if not path.exists(outputFileName(file, binary)):
+                print(f'start processing {file}')
+                with Timer():
+                    _processFile(file, ignored_urls, pool, jobs, binary)
+                    
+                print(f'done processing: {file}')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     print('done processing files\n\n')
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rules', help='A JSON file with the "ignored_prefixes" and "ignored_url_tags" lists to filter the urls by, the built-in lists are used if not given')
+    parser.add_argument('-j', '--jobs', help='Number of worker processes each file is split between, 1 processes the files in the main process', default=cpu_count(), type=int)
+    parser.add_argument('-b', '--binary', help='Write the keys as a raw little endian uint64 array file (.keys) instead of decimal lines', action='store_true')
+    args = parser.parse_args()
+    
     input_files_paths = [f for f in listdir('./input') if isfile(join('./input', f)) and f.startswith('wiki')] # can be downloaded from http://www.wikibench.eu/wiki and other wiki traces too
     
     makedirs(OUTPUT_DIR, exist_ok=True)
     
-    processFiles(input_files_paths)
+    processFiles(input_files_paths, loadFilter(args.rules), args.jobs, args.binary)
 
      
 if __name__ == '__main__':